@@ -0,0 +1,9 @@
+'''
+Performance benchmarks for ExpandCombinations
+
+python -m benchmarks run -o results.json
+python -m benchmarks compare before.json results.json
+'''
+
+from benchmarks.specs import benchmark_specs, synthetic_spec
+from benchmarks.runner import compare_results, measure, run_benchmarks
@@ -0,0 +1,73 @@
+#!bin/python
+# coding=utf-8
+
+'''
+Command line for the benchmarks: run them, or compare two saved runs
+'''
+
+# standard library imports
+import argparse
+import json
+import sys
+
+# local application/library specific imports
+from benchmarks.runner import compare_results, run_benchmarks
+from benchmarks.specs import benchmark_specs
+
+
+def _report(name: str, results: dict):
+    '''show the main measurements for a benchmark case as soon as it finishes'''
+    print('{:<20} {:>10} combinations  {:>12.0f}/s  first {:.6f}s  peak {:.0f} KiB  '
+          'plan {:.0f} KiB  iterator {:.0f} KiB'.format(
+              name, results['count'], results['per_second'], results['first_s'],
+              results['peak_kib'], results['plan_kib'], results['iterator_kib']))
+
+
+def main(argv: list = None) -> int:
+    '''run or compare benchmarks'''
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Benchmark ExpandCombinations.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='time the benchmark cases')
+    run.add_argument('-o', '--output', help='save the results to this JSON file')
+    run.add_argument('--limit', type=int, default=100000,
+                     help='most combinations to generate for each case')
+    run.add_argument('--repeat', type=int, default=3, help='runs to take the best time from')
+    run.add_argument('--case', action='append',
+                     help='only run the named case (can be repeated)')
+    compare = commands.add_parser('compare', help='flag regressions between two runs')
+    compare.add_argument('before', help='results JSON from the earlier run')
+    compare.add_argument('after', help='results JSON from the later run')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='fractional change to count as a regression (default 0.1)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        specs = benchmark_specs()
+        if args.case:
+            unknown = set(args.case) - set(specs)
+            if unknown:
+                parser.error('unknown case(s): {}'.format(', '.join(sorted(unknown))))
+            specs = {name: specs[name] for name in args.case}
+        results = run_benchmarks(specs, args.limit, args.repeat, _report)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as output:
+                json.dump(results, output, indent=2)
+        return 0
+
+    with open(args.before, encoding='utf-8') as before_file:
+        before = json.load(before_file)
+    with open(args.after, encoding='utf-8') as after_file:
+        after = json.load(after_file)
+    regressions = 0
+    for name, key, old, new, change, regressed in compare_results(before, after,
+                                                                  args.threshold):
+        regressions += regressed
+        print('{:<20} {:<12} {:>14.6g} {:>14.6g} {:>+8.1%}{}'.format(
+            name, key, old, new, change, '  REGRESSION' if regressed else ''))
+    print('{} regression(s)'.format(regressions))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
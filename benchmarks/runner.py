@@ -0,0 +1,111 @@
+#!bin/python
+# coding=utf-8
+
+'''
+Time expansions, and compare the results of two benchmark runs
+'''
+
+# standard library imports
+import gc
+import itertools
+import platform
+import sys
+import time
+import tracemalloc
+
+# local application/library specific imports
+from expand_combinations import ExpandCombinations, ExpansionPlan
+
+# measurements where a larger value is better.  Smaller is better for everything else
+HIGHER_IS_BETTER = frozenset(['per_second'])
+
+
+def _best_time(action, repeat: int) -> float:
+    '''returns the shortest of repeat runs of action, in seconds'''
+    best = None
+    for dummy_run in range(repeat):
+        started = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(spec: object, limit: int = 100000, repeat: int = 3) -> dict:
+    '''returns the measurements for expanding spec (up to limit combinations)'''
+    plan = ExpansionPlan(spec)
+    generated = min(plan.count(), limit)
+
+    def iterate():
+        for dummy_cmb in itertools.islice(ExpandCombinations(plan), limit):
+            pass
+
+    results = {
+        'count': plan.count(),
+        'generated': generated,
+        'construct_s': _best_time(lambda: ExpandCombinations(spec), repeat),
+        'first_s': _best_time(lambda: next(iter(ExpandCombinations(spec)), None), repeat),
+        'iterate_s': _best_time(iterate, repeat),
+    }
+    results['per_second'] = generated / results['iterate_s'] if results['iterate_s'] else 0.0
+
+    # memory held by the analysed plan, and by an iterator (the node state) sharing it
+    gc.collect()
+    tracemalloc.start()
+    held = ExpansionPlan(spec)
+    results['plan_kib'] = tracemalloc.get_traced_memory()[0] / 1024
+    walker = ExpandCombinations(held)
+    results['iterator_kib'] = tracemalloc.get_traced_memory()[0] / 1024 - results['plan_kib']
+    tracemalloc.stop()
+    del held, walker
+
+    # memory: the peak while iterating (without keeping the combinations) should stay
+    # flat, and the blocks still allocated per kept combination shows the result size
+    gc.collect()
+    tracemalloc.start()
+    iterate()
+    results['peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    kept_limit = min(generated, 10000)
+    before = sys.getallocatedblocks()
+    kept = list(itertools.islice(ExpandCombinations(plan), kept_limit))
+    results['blocks_per_result'] = ((sys.getallocatedblocks() - before) / kept_limit
+                                    if kept_limit else 0.0)
+    del kept
+    return results
+
+
+def run_benchmarks(specs: dict, limit: int = 100000, repeat: int = 3, report=None) -> dict:
+    '''returns the measurements for each of the specs, with details of the environment'''
+    results = {}
+    for name, spec in specs.items():
+        results[name] = measure(spec, limit, repeat)
+        if report is not None:
+            report(name, results[name])
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'limit': limit,
+        'results': results,
+    }
+
+
+def compare_results(before: dict, after: dict, threshold: float = 0.1) -> list:
+    '''returns (case, measurement, before, after, change, regressed) for common cases
+
+    change is the fractional change of the value, with a regression when that is
+    worse than threshold (a slow down for times, fewer combinations per second).'''
+    changes = []
+    for name, old in sorted(before['results'].items()):
+        new = after['results'].get(name)
+        if new is None:
+            continue
+        for key in ('construct_s', 'first_s', 'iterate_s', 'per_second', 'peak_kib',
+                    'plan_kib', 'iterator_kib'):
+            if key not in old or key not in new or not old[key]:
+                continue
+            change = (new[key] - old[key]) / old[key]
+            worse = -change if key in HIGHER_IS_BETTER else change
+            changes.append((name, key, old[key], new[key], change, worse > threshold, ))
+    return changes
@@ -0,0 +1,58 @@
+#!bin/python
+# coding=utf-8
+
+'''
+Generate input specifications with known shapes, to benchmark expansion against
+'''
+
+# standard library imports
+import random
+
+# local application/library specific imports
+from samples import sample_specs
+
+
+def synthetic_spec(depth: int = 2, width: int = 4, list_length: int = 3,
+                   nested_ratio: float = 0.25, shared_ratio: float = 0.0,
+                   static: int = 2, seed: int = 0) -> dict:
+    '''returns a dictionary specification built from the shape parameters
+
+    depth is the number of dictionary levels, width the number of list valued keys
+    in each dictionary, with list_length entries in each list.  nested_ratio is the
+    fraction of list entries (above the last level) that are nested dictionaries,
+    and shared_ratio the fraction of lists that reuse an already generated list
+    object (the same as the pizza toppings).  Each dictionary also gets static
+    (fixed value) keys.  The same parameters always generate the same specification.'''
+    rng = random.Random(seed)
+    shared = {}  # lists already generated, by level: candidates for reuse
+
+    def build(level: int) -> dict:
+        spec = {'static{}_{}'.format(level, idx): 'value {}'.format(idx)
+                for idx in range(static)}
+        for idx in range(width):
+            pool = shared.setdefault(level, [])
+            if pool and rng.random() < shared_ratio:
+                spec['key{}_{}'.format(level, idx)] = rng.choice(pool)
+                continue
+            options = []
+            for option in range(list_length):
+                if level < depth and rng.random() < nested_ratio:
+                    options.append(build(level + 1))
+                else:
+                    options.append('option {}'.format(option))
+            pool.append(options)
+            spec['key{}_{}'.format(level, idx)] = options
+        return spec
+    return build(1)
+
+
+def benchmark_specs() -> dict:
+    '''returns the specifications to benchmark, by name: samples and synthetic shapes'''
+    specs = {'sample_' + name: spec for name, spec in sample_specs().items()}
+    specs['flat_wide'] = synthetic_spec(depth=1, width=10, list_length=4, static=10)
+    specs['flat_long'] = synthetic_spec(depth=1, width=3, list_length=60)
+    specs['nested'] = synthetic_spec(depth=3, width=4, list_length=3, nested_ratio=0.3)
+    specs['deep'] = synthetic_spec(depth=6, width=2, list_length=2, nested_ratio=0.5)
+    specs['shared'] = synthetic_spec(depth=3, width=5, list_length=3, nested_ratio=0.3,
+                                     shared_ratio=0.6)
+    return specs
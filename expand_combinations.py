@@ -22,6 +22,36 @@ Generate combination 'merge' data from input nested dictionaries and lists
 # ??reserve?? tuple in ?both? cases for command tags
 #  ie. take value from ancestor value (explicit named cascade inherit)
 
+# standard library imports
+import argparse
+import asyncio
+import bisect
+import csv
+import gzip
+import io
+import itertools
+import json
+import math
+import operator
+import os
+import random
+import sys
+import time
+from collections import ChainMap, Counter, OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from types import MappingProxyType
+
+# related third party imports
+try:
+    import numpy
+except ImportError:  # optional: only needed for array batches
+    numpy = None
+try:
+    import yaml
+except ImportError:  # optional: only needed to read YAML specifications
+    yaml = None
+
 
 # Base design: Pass a dictionary object with member elements that have either simple or list
 # values.  Generate (and yield) a new dictionary for each combination of values in the lists.
@@ -36,33 +66,61 @@ class ExpandCombinations(object):
     '''generate sequences of dictionaries with unique data combinations from
     nested dictionaries and lists'''
 
-    def __init__(self, root: object):
-        self._state = {}
-        self._nested = []
-        self._state['static'] = {}  # content that passes through unprocessed
+    # one instance for every nested list or dictionary: keep them small
+    __slots__ = ('_plan', '_nested', '_layered', '_stats', '_path', '_constraints',
+                 '_static', '_mode', '_context', '_checks', '_static_ok', '_fast',
+                 '_product', '_positions', '_base', '_bottom_idx', '_intermediate',
+                 '_more_iterations', '_list_idx', '_nst_idx', '_unique', '_seen',
+                 '_start', '_stop', '_constrained_count', '_position', '_shortcut')
 
-        self._context = root
-        if isinstance(self._context, dict):
-            set_iterable = self._context.items()
-            # defines order that keys are added as child elements
-            self._state['mode'] = 'dict'  # maintain the source keys
-        elif not self.nestable_object(self._context):
-            set_iterable = []
-            self._state['mode'] = 'raw'  # return the raw root object
+    def __init__(self, root: object, shard: tuple = None, start: int = None, stop: int = None,
+                 unique: object = None, unordered: bool = False, interchangeable: object = None,
+                 layered: bool = False, resume: dict = None, constraints: object = None,
+                 stats: object = None):
+        if isinstance(root, ExpansionPlan):
+            if interchangeable is not None:
+                raise ValueError('interchangeable keys are set when the plan is created')
+            self._plan = root  # already analysed: just share it
         else:
-            set_iterable = enumerate(self._context)
-            self._state['mode'] = 'list'  # maintain the source sequence
-        # IDEA other processing when tuple?  tuple invalid as root?
+            self._plan = ExpansionPlan(root, interchangeable)
+        self._nested = []
+        # generate read-only views over shared fragments, instead of a dict per layer
+        self._layered = layered
+        # optional counters for the work done: shared by every node of the expansion
+        self._stats = None
+        if stats:
+            self._stats = stats if isinstance(stats, ExpansionStats) else ExpansionStats()
+        self._path = ()  # positions from the root down to this node
+        # rules every combination must satisfy.  Only checked in the nodes that generate
+        # final combinations: the root dictionary, or the entries of a root list.
+        self._constraints = tuple(rule if isinstance(rule, Constraint) else Constraint(rule)
+                                  for rule in constraints or ())
+        if self._constraints and self._plan.raw_results():
+            raise ValueError('constraints can only be used when every combination is a '
+                             'dictionary')
+        self._static = self._plan.static()  # content that passes through unprocessed
+        self._mode = self._plan.process_mode()
+        self._context = self._plan.source()
 
-        for idx, element in set_iterable:
-            if self.nestable_object(element):
-                self._populate_nested(idx, element)
-            else:
-                self._state['static'][idx] = element
-        self._state['more_iterations'] = True
-        self._state['list_idx'] = 0  # only used for list processing
-        # self._state['iter_idx'] = 0  # nested elements that need to be expanded/cascaded
-        self._nst_idx = 0  # nested elements that need to be expanded/cascaded
+        for pos_key, child_plan in self._plan.nested():
+            self._populate_nested(pos_key, child_plan)
+        follows = self._plan.layer_follows()  # previous layer in the same slot group
+        for layer, chld in enumerate(self._nested):
+            chld.follows = follows[layer]
+            chld.slot = follows[layer] is not None or layer in follows
+        # A dictionary with only simple list values (like s2 or meals) is a plain cartesian
+        # product of those lists.  Generate that directly, instead of layer by layer.
+        self._checks = None
+        self._static_ok = True
+        if self._constraints and self._mode == 'dict':
+            self._assign_checks()
+        self._fast = (self._mode == 'dict' and bool(self._nested) and not layered and
+                      self._checks is None and self._stats is None and
+                      all(chld.plan.simple_list() and not chld.slot
+                          for chld in self._nested))
+        self._product = None
+        self._positions = tuple(chld.position for chld in self._nested if not chld.empty)
+        self._base = dict(self._static)
         if self._is_list():
             # iteration covers all list elements, not just the nested cases
             self._bottom_idx = len(self._context) - 1
@@ -70,39 +128,409 @@ class ExpandCombinations(object):
             # iterate over only the nested elements
             self._bottom_idx = len(self._nested) - 1
         self._intermediate = [None for layer_number in range(len(self._nested) + 1)]
-        self._intermediate[0] = dict(self._state['static'])
+        self._rewind()
+        if self._stats is not None:
+            self._set_path(self._path)
+            self._instrument()
+
+        # Skip repeats of combinations already generated.  Not used for the nested elements
+        self._unique = None
+        self._seen = set()
+        if unique is not None and unique is not False:
+            self._unique = unique if callable(unique) else unique_key(
+                None if unique is True else unique, unordered)
+
+        # Only generate part of the expansion.  Not used for the nested elements
+        self._start = 0
+        self._stop = None
+        self._constrained_count = None
+        self._position = 0  # index of the next combination
+        self._shortcut = None  # standard iterator returned by __iter__ for a simple list
+        if resume is not None:  # continue from a checkpoint
+            if shard is not None or start is not None or stop is not None:
+                raise ValueError('use either resume or shard/start/stop, not both')
+            if resume['count'] != self._plan.count():
+                raise ValueError('checkpoint is for an expansion of {} combinations, '
+                                 'not {}'.format(resume['count'], self._plan.count()))
+            start, stop = resume['index'], resume['stop']
+        if shard is not None or start is not None or stop is not None:
+            if self._constraints:
+                raise ValueError('shards and ranges are not available with constraints')
+            self._start, self._stop = _range_bounds(self._plan.count(), shard, start, stop)
+            self._seek(self._start)
+            self._position = self._start
     # end def __init__()
 
-    def _populate_nested(self, pos_key, value):
+    def _assign_checks(self):
+        '''find the earliest layer where each constraint can be checked
+
+        That is the last layer that can set any of the keys the constraint looks at.
+        After that layer, those keys can not change, so a partial combination that
+        breaks the rule is skipped with every combination that would build on it.'''
+        layer_keys = self._plan.layer_keys()
+        self._checks = [[] for dummy_layer in layer_keys]
+        static_checks = []
+        for rule in self._constraints:
+            keys = rule.keys()
+            if keys is None:  # could look at anything: only check complete combinations
+                layer = len(layer_keys) - 1
+            else:
+                layer = max((idx for idx, written in enumerate(layer_keys)
+                             if not keys.isdisjoint(written)), default=-1)
+            (self._checks[layer] if layer >= 0 else static_checks).append(rule)
+        partial = (self._static, ) if self._layered else dict(self._static)
+        self._static_ok = self._allowed(static_checks, partial)
+
+    def _allowed(self, checks: list, partial: object) -> bool:
+        '''check a partial combination against the constraints for the layer just filled'''
+        if self._layered:
+            partial = _layered_view(partial)
+        return all(rule(partial) for rule in checks)
+
+    def _instrument(self):
+        '''switch this node to the counting versions of the hot path methods'''
+        self.__class__ = _CountingCombinations
+        for chld in self._nested:
+            self._time_layer(chld)
+
+    def _time_layer(self, chld: '_Layer'):
+        '''count and time the values taken from a nested element'''
+        record = self._stats.record
+        take_next = chld.next
+
+        def timed_next():
+            started = time.perf_counter()
+            value = take_next()
+            chld.merged = isinstance(value, (dict, LayeredCombination))
+            record('value', self._path + (chld.position, ), time.perf_counter() - started)
+            return value
+        chld.next = timed_next
+
+    def _set_path(self, path: tuple):
+        '''set the positions from the root down to this node (and the nodes below it)'''
+        self._path = path
+        for chld in self._nested:
+            if not chld.simple:
+                chld.iter._set_path(path + (chld.position, ))  # pylint: disable=W0212
+
+    def stats(self):
+        '''returns the ExpansionStats being recorded, or None when not counting'''
+        return self._stats
+
+    def _populate_nested(self, pos_key, child_plan):
         '''fill in information needed to process a single nested element'''
-        chld = {}  # Nested child element information
-        chld['position'] = pos_key
-        # Create ExpandCombinations instance for each nested combination entry.
-        # Need to keep the source nested elements around, to be able to recreate the
-        # iterators later: while doing the yo-yo processing to generate combinations
-        chld['combo'] = value
-        child_iter = ExpandCombinations(chld['combo'])
-        chld['simple'] = child_iter.simple_list()
-        chld['mode'] = child_iter.process_mode()
-        if chld['simple']:  # no special processing needed, so use standard iter function
-            chld['iter'] = iter(chld['combo'])  # keep context info, but throw out child_iter
+        chld = _Layer(pos_key, child_plan)  # Nested child element information
+        if self._mode == 'dict' and not chld.simple:
+            # A small nested element is only expanded once, then the saved combinations
+            # are merged as if they were a simple list.  They are never handed out.
+            materialised = child_plan.materialised()
+            if materialised is not None:
+                chld.values = materialised
+                chld.simple = True
+        if self._layered and chld.simple and self._mode == 'dict':
+            # build the {position: value} fragment for each value once, then share it
+            chld.values = tuple(value if isinstance(value, dict) else {pos_key: value}
+                                for value in chld.values)
+        if chld.simple:  # no special processing needed, so use standard iter function
+            chld.iter = iter(chld.values)
+            chld.next = chld.iter.__next__
         else:  # need to use the extended processing provided by the local class
-            chld['iter'] = child_iter
+            # list entries generate final combinations, so the constraints move down
+            chld.iter = ExpandCombinations(
+                child_plan, layered=self._layered,
+                constraints=self._constraints if self._is_list() else None, stats=self._stats)
+            # skip the root only (range and unique) handling done by __next__
+            chld.next = chld.iter._next_combination  # pylint: disable=protected-access
         self._nested.append(chld)  # add child information to nested list
     # end def _populate_nested()
 
+    def _rewind(self):
+        '''go back to the first combination of this layer only
+
+        Nested iterators are always restarted as soon as they run out, so they are
+        already positioned at their own first entry when this is needed.'''
+        self._more_iterations = self._plan.count() > 0 and self._static_ok
+        self._list_idx = 0  # only used for list processing
+        self._nst_idx = 0  # nested elements that need to be expanded/cascaded
+        if self._fast:  # an empty list merges nothing, so it is left out of the product
+            self._product = itertools.product(
+                *(chld.values for chld in self._nested if not chld.empty))
+        if self._layered:  # the (read-only) static values are the bottom fragment
+            self._intermediate[0] = (self._static, )
+        else:
+            self._intermediate[0] = dict(self._static)
+
+    @staticmethod
+    def _restart_nested(chld: '_Layer'):
+        '''put the iterator for an exhausted nested element back to its first entry'''
+        if chld.simple:
+            chld.iter = iter(chld.values)
+            chld.next = chld.iter.__next__
+        else:
+            chld.iter._rewind()  # pylint: disable=protected-access
+        chld.spent = False
+        chld.digit = -1
+
+    def reset(self):
+        '''start over again from the first combination (of the shard or range)'''
+        self._seen.clear()
+        self._move_to(self._start)
+
+    def _move_to(self, index: int):
+        '''restart from scratch, positioned so that the next combination is index'''
+        for chld in self._nested:
+            if not chld.simple:
+                chld.iter.reset()
+            self._restart_nested(chld)
+        self._rewind()
+        self._shortcut = None
+        self._position = index
+        if index > 0 or self._stop is not None:
+            self._seek(index)
+
+    def checkpoint(self) -> dict:
+        '''returns a (small, json friendly) token for the position of the iterator
+
+        ExpandCombinations(root, resume=token) continues from the next combination,
+        seeking directly to it the same way as a shard does.'''
+        if self._unique is not None:
+            raise ValueError('the combinations already seen (for unique) are not saved')
+        if self._constraints:
+            raise ValueError('checkpoints are not available with constraints')
+        position = self._position
+        if self._shortcut is not None:  # being iterated by the standard list iterator
+            position = self._plan.count() - operator.length_hint(self._shortcut)
+        return {'index': position, 'stop': self._stop, 'count': self._plan.count()}
+
+    def _seek(self, index: int):
+        '''position a freshly (re)started iterator so that the next combination is index
+
+        Each layer is moved directly to the entry needed, the same way that random
+        access locates a combination, without generating anything before it.'''
+        if index > 0:
+            self._fast = False  # the general engine can start part way through
+        if index >= self._plan.count():
+            self._more_iterations = False
+            return
+        if self._is_list():
+            entry_idx, offset = self._plan.locate_entry(index)
+            self._list_idx = entry_idx
+            self._nst_idx = sum(1 for chld in self._nested if chld.position < entry_idx)
+            if entry_idx not in self._static:
+                self._seek_nested(self._nested[self._nst_idx], offset)
+            return
+        if not self._nested:
+            return  # raw object or fixed dictionary: only index 0 exists
+        for layer, digit in enumerate(self._plan.layer_digits(index)):
+            self._nst_idx = layer
+            self._seek_nested(self._nested[layer], digit)
+            self._nested[layer].digit = digit - 1
+            if layer < self._bottom_idx:
+                self._next_partial()  # take the value, ready for the following layers
+
+    @staticmethod
+    def _seek_nested(chld: '_Layer', index: int):
+        '''position the iterator for a (fresh) nested element to start at index'''
+        if index <= 0:
+            return
+        if not chld.simple:
+            chld.iter._seek(index)  # pylint: disable=protected-access
+        elif hasattr(chld.iter, '__setstate__'):
+            chld.iter.__setstate__(index)  # list and tuple iterators can jump directly
+        else:
+            next(itertools.islice(chld.iter, index, index), None)
+
+    def plan(self):
+        '''returns the (shared, immutable) expansion plan being iterated'''
+        return self._plan
+
+    def count(self):
+        '''returns the number of combinations in a full expansion, without generating any
+
+        With constraints that each look at the static values and (at most) a single
+        layer, the count is the product of the values each layer allows.  Otherwise
+        (rules looking at several layers, rules without keys, or interchangeable
+        slots) the pruned expansion is generated once to count exactly.'''
+        if not self._constraints:
+            return self._plan.count()
+        if self._constrained_count is None:
+            self._constrained_count = _allowed_count(self._plan, self._constraints)
+        if self._constrained_count is None:
+            self._constrained_count = sum(1 for dummy_cmb in self._constrained())
+        return self._constrained_count
+
+    def _constrained(self):
+        '''returns a fresh iterator over the full (pruned) expansion'''
+        return ExpandCombinations(self._plan, layered=True, constraints=self._constraints)
+
+    def _indexed(self):
+        '''refuse index based access, when constraints change the indices'''
+        if self._constraints:
+            raise ValueError('combination indices are not available with constraints')
+        return self._plan
+
+    def __getitem__(self, index):
+        '''random access to the full expansion; independent of the iteration position'''
+        return self._indexed()[index]
+
+    def sample(self, k: int, seed: object = None) -> list:
+        '''returns k different combinations, picked uniformly at random
+
+        With constraints, the (pruned) expansion is generated once to collect the
+        picked combinations.  When the count can not be calculated (see count), the
+        picks are made during that same pass (reservoir sampling).'''
+        if not self._constraints:
+            return self._plan.sample(k, seed)
+        rng = random.Random(seed)
+        if _allowed_count(self._plan, self._constraints) is None:
+            chosen = []
+            total = 0
+            for combination in self._constrained():
+                if total < k:
+                    chosen.append(combination.to_dict())
+                else:
+                    slot = rng.randrange(total + 1)
+                    if slot < k:
+                        chosen[slot] = combination.to_dict()
+                total += 1
+            self._constrained_count = total
+            if total < k:
+                raise ValueError('sample of {} is larger than the {} combinations'.format(
+                    k, total))
+            rng.shuffle(chosen)
+            return chosen
+        picked = rng.sample(range(self.count()), k)
+        order = {idx: rank for rank, idx in enumerate(picked)}
+        chosen = [None] * k
+        for idx, combination in enumerate(self._constrained()):
+            if idx in order:
+                chosen[order[idx]] = combination.to_dict()
+        return chosen
+
+    def random_stream(self, seed: object = None):
+        '''endlessly generate combinations picked (with replacement) uniformly at random
+
+        With constraints, picks that break a rule are skipped (rejection sampling).'''
+        if not self._constraints:
+            return self._plan.random_stream(seed)
+        if not self.count():
+            return iter(())
+        return (combination for combination in self._plan.random_stream(seed)
+                if all(rule(combination) for rule in self._constraints))
+
+    def index_of(self, combination: object) -> int:
+        '''returns the first index where combination is generated; ValueError if never'''
+        return self._indexed().index_of(combination)
+
+    def indices_of(self, combination: object) -> list:
+        '''returns the index of every position where combination is generated'''
+        return self._indexed().indices_of(combination)
+
+    def __contains__(self, combination: object) -> bool:
+        '''check if combination is generated, without consuming the iterator'''
+        return combination in self._plan and all(rule(combination)
+                                                 for rule in self._constraints)
+
+    def project(self, keys: object) -> list:
+        '''returns the distinct values of keys over the full expansion (see ExpansionPlan)'''
+        if self._constraints:
+            raise ValueError('projections are not available with constraints')
+        return self._plan.project(keys)
+
+    def histogram(self, key: object) -> Counter:
+        '''returns the number of combinations with each value of key (see ExpansionPlan)'''
+        if self._constraints:
+            raise ValueError('histograms are not available with constraints')
+        return self._plan.histogram(key)
+
+    def aggregate(self, keys: object = None) -> dict:
+        '''returns the histogram for each of keys (see ExpansionPlan)'''
+        if self._constraints:
+            raise ValueError('histograms are not available with constraints')
+        return self._plan.aggregate(keys)
+
+    def gray_code(self):
+        '''generate the full expansion in minimal change order (see ExpansionPlan)'''
+        if self._constraints:
+            raise ValueError('minimal change order is not available with constraints')
+        return self._plan.gray_code()
+
+    def deltas(self, gray: bool = True):
+        '''generate the changes between consecutive combinations (see ExpansionPlan)'''
+        if self._constraints:
+            raise ValueError('minimal change order is not available with constraints')
+        return self._plan.deltas(gray)
+
+    def encodings(self):
+        '''generate the index tuple for each combination (see ExpansionPlan)'''
+        if self._constraints:
+            raise ValueError('index tuples are not available with constraints')
+        return self._plan.encodings()
+
+    def batches(self, size: int, arrays: bool = False):
+        '''generate the remaining combinations in blocks of (up to) size, as columns
+
+        Each block is a dictionary with a list of values for each key a combination
+        can contain, with MISSING where a combination does not contain the key.  With
+        arrays, each block is a numpy masked structured array instead, with an object
+        field for each key, masked where the key is missing.  The layered fragments
+        are written straight to the columns, without building any row dictionaries.
+        A (not layered) iterator hands its remaining range to a layered iterator over
+        the same plan, and is moved past each block as it is generated.'''
+        if size < 1:
+            raise ValueError('batch size must be at least 1, not {!r}'.format(size))
+        if arrays and numpy is None:
+            raise ImportError('numpy is needed for array batches')
+        if self._plan.raw_results():
+            raise ValueError('only dictionary combinations can be split into columns')
+        if not self._plan.result_keys():
+            raise ValueError('the combinations have no keys to split into columns')
+        if not self._layered:
+            if self._unique is not None or self._constraints:
+                raise ValueError('create the iterator with layered=True for batches using '
+                                 'unique or constraints')
+            stop = self._plan.count() if self._stop is None else self._stop
+            position = None
+            while True:
+                if self.checkpoint()['index'] != position:  # (also) moved by next()
+                    position = self.checkpoint()['index']
+                    blocks = ExpandCombinations(self._plan, start=position, stop=stop,
+                                                layered=True).batches(size, arrays)
+                batch = next(blocks, None)
+                if batch is None:
+                    self._move_to(stop)
+                    return
+                position += len(batch) if arrays else len(next(iter(batch.values())))
+                self._move_to(position)
+                yield batch
+        # the static values are the same for every row: fill those columns in advance
+        skip = 1 if self._layered and self._mode == 'dict' else 0
+        fill = [(key, self._static.get(key, MISSING) if skip else MISSING)
+                for key in self._plan.result_keys()]
+        while True:
+            block = list(itertools.islice(self, size))
+            if not block:
+                return
+            batch = {key: [value] * len(block) for key, value in fill}
+            for row_idx, combination in enumerate(block):
+                fragments = (combination.maps[:len(combination.maps) - skip]
+                             if self._layered else (combination, ))
+                for fragment in reversed(fragments):  # cascade: later layers override
+                    for key, value in fragment.items():
+                        batch[key][row_idx] = value
+            yield _batch_array(batch, len(block)) if arrays else batch
+
     def _is_list(self):
         '''returns true when the input to the instance is a list'''
-        return self._state['mode'] == 'list'
+        return self._mode == 'list'
 
     def simple_list(self):
         '''returns true when no special handling is needed to iterate self._context'''
-        # standard iterator breaks when _context is a dictionary: only get keys
-        return not self._nested and self._is_list()
+        return self._plan.simple_list()
 
     def process_mode(self):
         '''returns the internal processing mode'''
-        return self._state['mode']
+        return self._mode
 
     @staticmethod
     def nestable_object(obj: object):
@@ -116,68 +544,108 @@ class ExpandCombinations(object):
         # not called when only using next(), which is what is done for the recursive
         # processing done by this class for the nested nodes.  Only gets here when
         # for … in processing is used by an external caller.  Never interally.
-        if self.simple_list():
+        if (self.simple_list() and self._stop is None and self._unique is None and
+                self._stats is None):
             # use standard iterator when nothing special needs handling
-            return iter(self._context)
+            self._shortcut = iter(self._context)
+            return self._shortcut
+        if self._fast and self._stop is None and self._unique is None:
+            return self._product_combinations()
         # need the full nested/recursive processing this class provides
         return self
 
+    def __aiter__(self):
+        '''return an asynchronous iterator, for async for, that shares the event loop'''
+        return AsyncCombinations(self)
+
+    def _product_combinations(self):
+        '''generate the (remaining) combinations of a dictionary of simple lists'''
+        base = self._base
+        positions = self._positions
+        for values in self._product:
+            combination = base.copy()
+            combination.update(zip(positions, values))
+            self._position += 1
+            yield combination
+
     def _next_list_entry(self):
         '''return the next entry for the current list'''
         while True:
-            if self._state['list_idx'] in self._state['static']:
-                if self._state['list_idx'] >= self._bottom_idx:
+            if self._list_idx in self._static:
+                if self._list_idx >= self._bottom_idx:
                     # This is the final item in the list, so stop at start of next pass
-                    self._state['more_iterations'] = False
-                static_entry = self._state['static'][self._state['list_idx']]
-                self._state['list_idx'] += 1  # increment saved index BEFORE returning entry
+                    self._more_iterations = False
+                static_entry = self._static[self._list_idx]
+                self._list_idx += 1  # increment saved index BEFORE returning entry
                 return static_entry
             try:
                 # called iter should have handled any needed «deep» copy
-                return next(self._nested[self._nst_idx]['iter'])
+                return self._nested[self._nst_idx].next()
             except StopIteration as dummy_exc:  # no more «variant» values for list_idx entry
+                # ready for the next time this list is expanded
+                self._restart_nested(self._nested[self._nst_idx])
                 self._nst_idx += 1  # setup to process next nested element, if exists
-                if self._state['list_idx'] >= self._bottom_idx:
+                if self._list_idx >= self._bottom_idx:
+                    self._more_iterations = False
                     raise  # done last list entry, so stop right here, right now
-            self._state['list_idx'] += 1  # process next list entry, next pass (of while)
+            self._list_idx += 1  # process next list entry, next pass (of while)
         # end while True
     # end def _next_list_entry()
 
     def _check_next_done(self):
         '''handle various special, early exit cases for __next__'''
-        if not self._state['more_iterations']:
+        if not self._more_iterations:
             raise StopIteration()
         end_next = False
         next_val = None
 
-        if self._state['mode'] == 'raw':
-            self._state['more_iterations'] = False
+        if self._mode == 'raw':
+            self._more_iterations = False
             end_next = True
             next_val = self._context
 
-        elif not self._nested:
-            self._state['more_iterations'] = False
-            end_next = True
-            next_val = self._intermediate[0]  # copy done when created
-
         elif self._is_list():
             end_next = True
             next_val = self._next_list_entry()
 
+        elif not self._nested:
+            self._more_iterations = False
+            end_next = True
+            next_val = self._intermediate[0]  # copy done when (re)started
+            if self._layered:
+                next_val = _layered_view(next_val)
+
         return (end_next, next_val, )
     # end def _check_next_done()
 
     def _next_partial(self):
         '''get the value for the next layer of the expansion'''
         next_nest_idx = self._nst_idx + 1  # used multple times; calc once
-        if self._nested[self._nst_idx]['combo'] is None:
-            self._nested[self._nst_idx]['combo'] = []  # allow recreate iteration
-            raise StopIteration()
-        if self._nested[self._nst_idx]['combo'] == []:
+        chld = self._nested[self._nst_idx]
+        if chld.slot:  # interchangeable: never use an earlier option than the previous slot
+            if chld.digit < 0 and chld.follows is not None:
+                chld.digit = self._nested[chld.follows].digit - 1
+                self._seek_nested(chld, chld.digit + 1)
+            chld.digit += 1
+        if chld.empty:
+            if chld.spent:
+                raise StopIteration()  # the single (empty) value has already been used
             element_value = {}  # merge of empty dictionary is same as original
-            self._nested[self._nst_idx]['combo'] = None  # prevent repeats here
+            chld.spent = True  # prevent repeats here
         else:
-            element_value = next(self._nested[self._nst_idx]['iter'])
+            element_value = chld.next()
+        if self._layered:  # stack shared fragments, instead of copying the partial combination
+            if chld.empty:
+                fragments = ()
+            elif isinstance(element_value, LayeredCombination):
+                fragments = tuple(element_value.maps)
+            elif chld.simple:
+                fragments = (element_value, )  # pre-built (shared) fragment
+            else:
+                fragments = ({chld.position: element_value}, )
+            # newest first, the same as the lookup order for a ChainMap
+            self._intermediate[next_nest_idx] = fragments + self._intermediate[self._nst_idx]
+            return next_nest_idx
         # Fresh copy of current partial expanded combination
         self._intermediate[next_nest_idx] = self._intermediate[self._nst_idx].copy()
         if isinstance(element_value, dict):
@@ -185,12 +653,34 @@ class ExpandCombinations(object):
             self._intermediate[next_nest_idx].update(element_value)
         else:
             # set the existing entry to the calculated value
-            self._intermediate[next_nest_idx][
-                self._nested[self._nst_idx]['position']] = element_value
+            self._intermediate[next_nest_idx][chld.position] = element_value
         return next_nest_idx
 
     def __next__(self):
         '''return the next combination from the root data set'''
+        if self._unique is None:
+            return self._next_in_range()
+        while True:  # keep going until get a combination that has not been seen before
+            combination = self._next_in_range()
+            identity = self._unique(combination)
+            if identity not in self._seen:
+                self._seen.add(identity)
+                return combination
+
+    def _next_in_range(self):
+        '''return the next combination, stopping at the end of the requested range'''
+        if self._stop is not None and self._position >= self._stop:
+            raise StopIteration()  # only generating part of the expansion
+        combination = self._next_combination()
+        self._position += 1
+        return combination
+
+    def _next_combination(self):
+        '''return the next combination for the current layer'''
+        if self._fast:
+            combination = self._base.copy()
+            combination.update(zip(self._positions, next(self._product)))
+            return combination
         done_next, next_value = self._check_next_done()
         if done_next:
             return next_value
@@ -199,25 +689,1558 @@ class ExpandCombinations(object):
         while True:  # keep going, until have complete combination to return
             try:
                 int_idx = self._next_partial()
+                if self._checks is not None and self._checks[self._nst_idx] and not self._allowed(
+                        self._checks[self._nst_idx], self._intermediate[int_idx]):
+                    continue  # skip everything built on this partial combination
                 if self._nst_idx == self._bottom_idx:  # yo-yo spin in place
+                    if self._layered:
+                        return _layered_view(self._intermediate[int_idx])
                     return self._intermediate[int_idx]  # already cloned
                 self._nst_idx += 1  # yo-yo down on non-final element_value for combination
             except StopIteration as dummy_exc:
-                # no more values for the current (self._nst_idx) iterator
+                # no more values for the current (self._nst_idx) iterator.  Restart it
+                # (without analysing the source again), ready for the next outer value.
+                self._restart_nested(self._nested[self._nst_idx])
                 if self._nst_idx <= 0:  # nothing more in the TOP (0) layer/list
+                    self._more_iterations = False
                     raise  # all done
-                # reset the iterator on the current (just emptied) layer (depth)
-                if self._nested[self._nst_idx]['simple']:
-                    self._nested[self._nst_idx]['iter'] = iter(
-                        self._nested[self._nst_idx]['combo'])
-                else:
-                    self._nested[self._nst_idx]['iter'] = ExpandCombinations(
-                        self._nested[self._nst_idx]['combo'])
                 self._nst_idx -= 1  # yo-yo up after handling (non terminal) exception
-    # end def __next__()
+    # end def _next_combination()
 # end class ExpandCombinations()
 
 
+class _Layer(object):
+    '''processing state for a single nested element (layer) of an expansion'''
+    __slots__ = ('position', 'plan', 'simple', 'mode', 'empty', 'spent', 'digit', 'values',
+                 'iter', 'next', 'follows', 'slot', 'merged')
+
+    def __init__(self, position: object, plan: 'ExpansionPlan'):
+        self.position = position
+        # The child plan holds everything already learned about the nested element.  It
+        # is used to restart the iterator later, while doing the yo-yo processing to
+        # generate combinations, without analysing the source element again.
+        self.plan = plan
+        self.simple = plan.simple_list()
+        self.mode = plan.process_mode()
+        self.empty = plan.empty_list()
+        self.spent = False  # only used for an empty list: the single {} has been merged
+        self.digit = -1  # only used for interchangeable slots: index of the current value
+        self.values = plan.source()
+        self.iter = None
+        self.next = None
+        self.follows = None  # previous layer in the same slot group
+        self.slot = False  # interchangeable slot
+        self.merged = False  # (only counted with stats) the last value was a dictionary
+# end class _Layer()
+
+
+class _CountingCombinations(ExpandCombinations):
+    '''ExpandCombinations node that records the work done in its ExpansionStats
+
+    Only nodes created with stats are switched to this class, so the normal hot path
+    methods have no extra cost at all when not counting.'''
+    __slots__ = ()
+
+    def _next_partial(self):
+        chld = self._nested[self._nst_idx]
+        next_nest_idx = super()._next_partial()
+        if not self._layered:  # fresh copy, then merge or set the layer value
+            path = self._path + (chld.position, )
+            self._stats.record('copy', path)
+            self._stats.record('update' if chld.empty or chld.merged else 'set', path)
+        return next_nest_idx
+
+    def _restart_nested(self, chld: _Layer):
+        ExpandCombinations._restart_nested(chld)
+        if chld.simple:
+            self._time_layer(chld)  # new standard iterator
+        self._stats.record('restart', self._path + (chld.position, ))
+
+    def _next_in_range(self):
+        combination = super()._next_in_range()
+        self._stats.record('result', self._path)
+        return combination
+# end class _CountingCombinations()
+
+
+class AsyncCombinations(object):
+    '''asynchronous iteration over the combinations of an expansion
+
+    Generating combinations never waits for anything, so a large expansion would hold
+    the event loop for as long as it takes.  Instead, combinations are generated in
+    blocks of up to every combinations, stopping early when a block has taken interval
+    seconds, and the event loop gets a turn before each block.  Nothing more is
+    generated until the consumer has used the block, so a slow consumer (writing to a
+    database) holds back the generation.  source is anything ExpandCombinations
+    accepts (with any of its keyword arguments), or an ExpandCombinations instance.'''
+    _STEP = 32  # combinations generated between checks of the time used
+
+    def __init__(self, source: object, every: int = 1000, interval: float = 0.005,
+                 **kwargs):
+        if every < 1:
+            raise ValueError('every must be at least 1')
+        if isinstance(source, ExpandCombinations):
+            if kwargs:
+                raise ValueError('options for ExpandCombinations can not be applied to an '
+                                 'existing iterator: {}'.format(', '.join(sorted(kwargs))))
+            self._walker = source
+        else:
+            self._walker = ExpandCombinations(source, **kwargs)
+        self._iterator = iter(self._walker)
+        self._every = every
+        self._interval = interval
+        self._block = deque()
+        self._done = False
+
+    def walker(self) -> ExpandCombinations:
+        '''returns the ExpandCombinations iterator being wrapped
+
+        The wrapped iterator has already generated the rest of the current block, so
+        use the checkpoint of this (asynchronous) iterator instead of its checkpoint.'''
+        return self._walker
+
+    def checkpoint(self) -> dict:
+        '''returns a token for the position of the next combination to be handed out
+
+        The same as ExpandCombinations.checkpoint, less the combinations generated
+        for the current block that have not been used yet.'''
+        token = self._walker.checkpoint()
+        token['index'] -= len(self._block)
+        return token
+
+    def __aiter__(self):
+        return self
+
+    async def _fill(self):
+        '''give the event loop a turn, then generate the next block of combinations'''
+        await asyncio.sleep(0)
+        deadline = time.perf_counter() + self._interval
+        block = self._block
+        wanted = len(block) + self._every
+        while len(block) < wanted:
+            step = min(self._STEP, wanted - len(block))
+            before = len(block)
+            block.extend(itertools.islice(self._iterator, step))
+            if len(block) - before < step:
+                self._done = True
+                return
+            if time.perf_counter() >= deadline:
+                return
+
+    async def __anext__(self):
+        if not self._block:
+            if not self._done:
+                await self._fill()
+            if not self._block:
+                raise StopAsyncIteration
+        return self._block.popleft()
+
+    async def batches(self, size: int):
+        '''generate lists of (up to) size combinations, for bulk operations'''
+        if size < 1:
+            raise ValueError('batch size must be at least 1')
+        block = self._block
+        while True:
+            while len(block) < size and not self._done:
+                await self._fill()
+            if not block:
+                return
+            yield [block.popleft() for dummy_idx in range(min(size, len(block)))]
+# end class AsyncCombinations()
+
+
+class ExpansionStats(object):
+    '''counts of the work done while generating combinations
+
+    Pass stats=True (or an ExpansionStats instance to share) to ExpandCombinations.
+    Each event is counted in total, and for the layer it happened in, identified by
+    the positions (keys or list indices) from the root down to that layer:
+      value    a value taken from a nested layer (with the time taken, which includes
+               everything done by the layers nested inside it)
+      copy     a partial combination copied, ready to merge or set a layer value
+      update   a (dictionary) layer value merged into the copy
+      set      a (non dictionary) layer value set at the position key of the copy
+      restart  an exhausted layer restarted from its first value
+      result   a combination returned from the root (the layer is ())
+    callback, when given, is called with (event, layer, seconds) for every event.'''
+
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._totals = Counter()
+        self._layers = {}
+
+    def record(self, event: str, layer: tuple, seconds: float = 0.0):
+        '''count one event for layer'''
+        self._totals[event] += 1
+        counts = self._layers.get(layer)
+        if counts is None:
+            counts = self._layers[layer] = Counter()
+        counts[event] += 1
+        if seconds:
+            counts['seconds'] += seconds
+        if self._callback is not None:
+            self._callback(event, layer, seconds)
+
+    def totals(self) -> dict:
+        '''returns the number of each event, for the whole expansion'''
+        return dict(self._totals)
+
+    def layers(self) -> dict:
+        '''returns the counts (and time spent getting values, in seconds) by layer'''
+        return {layer: dict(counts) for layer, counts in self._layers.items()}
+
+    def clear(self):
+        '''start counting again from zero'''
+        self._totals.clear()
+        self._layers.clear()
+# end class ExpansionStats()
+
+
+class LayeredCombination(ChainMap):
+    '''read-only view of a combination, layered over fragments shared with other combinations
+
+    Generated by ExpandCombinations(..., layered=True), instead of copying the partial
+    combination into a new dictionary for every layer.  The maps are searched from the
+    last merged fragment back to the static values, so every lookup sees the same
+    (cascaded) value the dictionary would contain.  Keys are in the same order too.'''
+
+    def _read_only(self, *dummy_args, **dummy_kwargs):
+        '''the fragments are shared: changing one would change other combinations too'''
+        raise TypeError('{} is read-only; use to_dict() to get a dictionary that can be '
+                        'changed'.format(type(self).__name__))
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    pop = popitem = clear = update = setdefault = _read_only
+
+    def to_dict(self) -> dict:
+        '''returns the combination as a (new, independent) dictionary'''
+        combination = {}
+        for fragment in reversed(self.maps):  # cascade, the same as iteration does
+            combination.update(fragment)
+        return combination
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+# end class LayeredCombination()
+
+
+class _Missing(object):
+    '''marker for a key that is not in a combination, in column (batch) output'''
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'  # keep the single instance when pickled
+
+
+MISSING = _Missing()
+
+
+def _batch_array(batch: dict, rows: int):
+    '''returns the columns of a batch as a numpy masked structured (object) array'''
+    data = numpy.empty(rows, dtype=[(str(key), object) for key in batch])
+    mask = numpy.zeros(rows, dtype=[(str(key), bool) for key in batch])
+    for key, column in batch.items():
+        field = data[str(key)]
+        for row_idx, value in enumerate(column):
+            field[row_idx] = value  # one at a time: sequence values are not spread out
+        mask[str(key)] = [value is MISSING for value in column]
+    return numpy.ma.array(data, mask=mask)
+
+
+def _range_bounds(total: int, shard: tuple, start: int, stop: int) -> tuple:
+    '''returns the (start, stop) indices for the requested part of total combinations'''
+    if shard is None:
+        span = range(total)[slice(start, stop)]  # same as slicing a list
+        return (span.start, max(span.start, span.stop), )
+    if start is not None or stop is not None:
+        raise ValueError('use either shard or start/stop, not both')
+    shard_idx, shard_count = shard
+    if not 0 <= shard_idx < shard_count:
+        raise ValueError('shard {!r} is not (index, count) with 0 <= index < count'.format(
+            shard))
+    # contiguous blocks, so each shard keeps the original order, and all of the
+    # shards together cover every combination exactly once
+    return (shard_idx * total // shard_count, (shard_idx + 1) * total // shard_count, )
+
+
+def _allowed_count(plan: 'ExpansionPlan', rules: tuple) -> int:
+    '''returns the number of combinations of plan allowed by every rule, or None
+
+    The same as the constraints checked while generating: list entries are counted
+    separately (and added), while the dictionary layers multiply.  When every rule
+    only looks at keys written by the static values plus (at most) one layer, each
+    rule is checked against just the values of that layer.  None when that is not
+    enough to count exactly: a rule without keys, a rule spanning layers, or slots.'''
+    if plan.process_mode() == 'list':
+        total = 0
+        for dummy_pos, child_plan in plan.nested():
+            count = _allowed_count(child_plan, rules)
+            if count is None:
+                return None
+            total += count
+        return total
+    if any(follows is not None for follows in plan.layer_follows()):
+        return None  # slot values depend on the previous slot
+    layer_keys = plan.layer_keys()
+    checks = [[] for dummy_layer in layer_keys]
+    static = dict(plan.static())
+    for rule in rules:
+        if rule.keys() is None:
+            return None
+        layers = [idx for idx, written in enumerate(layer_keys)
+                  if not rule.keys().isdisjoint(written)]
+        if len(layers) > 1:
+            return None
+        if not layers:  # only the static values
+            if not rule(static):
+                return 0
+            continue
+        checks[layers[0]].append(rule)
+    total = 1
+    for (pos_key, child_plan), layer_checks in zip(plan.nested(), checks):
+        if not layer_checks:
+            total *= child_plan.layer_count()
+            continue
+        allowed = 0
+        for digit in range(child_plan.count()):
+            partial = dict(static)
+            value = child_plan[digit]
+            if isinstance(value, dict):
+                partial.update(value)
+            else:
+                partial[pos_key] = value
+            allowed += all(rule(partial) for rule in layer_checks)
+        total *= allowed
+    return total
+
+
+def _layered_view(maps: tuple) -> LayeredCombination:
+    '''wrap (newest first) fragments, without the list copy done by ChainMap.__init__'''
+    view = object.__new__(LayeredCombination)
+    view.maps = maps  # a tuple: nothing can be added to or removed from the stack either
+    return view
+
+
+class ExpansionPlan(object):
+    '''immutable, pre-analysed description of how a root object expands
+
+    The source is walked once, when the plan is created, building a child plan
+    for every nested list or dictionary.  Nothing in a plan changes after that,
+    so any number of independent ExpandCombinations iterators (in any threads)
+    can walk the same plan, and restarting a nested layer never needs to look
+    at the source again.  The source should not be modified while in use.
+
+    interchangeable lists groups of dictionary keys that are slots filled from the
+    same options, where the order does not matter (like pizza toppings).  Only one
+    combination is generated for each multiset of slot values: the values picked
+    for the slots never go back to an earlier option than the previous slot.'''
+
+    # one plan for every (distinct) nested list or dictionary: keep them small
+    __slots__ = ('_context', '_interchangeable', '_cache', '_static', '_nested', '_mode',
+                 '_empty', '_count', '_entries', '_starts', '_lookup', '_slot_groups',
+                 '_follows', '_materialised', '_layer_keys', '_written', '_keys')
+
+    def __init__(self, root: object, interchangeable: object = None, cache: object = None):
+        static = {}
+        nested = []
+        entries = []  # (is nested, static value or child plan) for every element
+
+        self._interchangeable = tuple(frozenset(group) for group in interchangeable or ())
+        self._context = root
+        # nested elements that appear more than once (like the pizza toppings lists) are
+        # only analysed once, and share the same child plan
+        self._cache = PlanCache() if cache is None else cache
+        self._materialised = None  # the combinations of a small expansion, once generated
+        if isinstance(root, dict):
+            set_iterable = root.items()
+            self._mode = 'dict'  # maintain the source keys
+        elif not ExpandCombinations.nestable_object(root):
+            set_iterable = []
+            self._mode = 'raw'  # return the raw root object
+        else:
+            set_iterable = enumerate(root)
+            self._mode = 'list'  # maintain the source sequence
+
+        for idx, element in set_iterable:
+            if ExpandCombinations.nestable_object(element):
+                nested.append((idx, self._cache.plan(element, self._interchangeable), ))
+                entries.append((True, nested[-1][1], ))
+            else:
+                static[idx] = element
+                entries.append((False, element, ))
+        self._static = MappingProxyType(static)  # content that passes through unprocessed
+        self._nested = tuple(nested)  # (position, child plan) for each nested element
+        # an empty list as a dictionary value expands to (merges) an empty dictionary
+        self._empty = self._mode == 'list' and not static and not nested and root == []
+
+        # Number of combinations, from the (already calculated) child counts.  List
+        # entries add, dictionary layers multiply, and a raw object is a single entry.
+        self._entries = ()
+        self._starts = ()  # index of the first combination from each list entry
+        if self._mode == 'list':
+            self._entries = tuple(entries)
+            starts = []
+            self._count = 0
+            for is_nested, entry in self._entries:
+                starts.append(self._count)
+                self._count += entry.count() if is_nested else 1
+            self._starts = tuple(starts)
+        self._slot_groups = ()  # layer numbers for each group of interchangeable slots
+        self._follows = tuple(None for dummy_layer in nested)  # previous slot in the group
+        if self._mode != 'list':
+            self._find_slots()
+            self._count = self._completions(-1, [])
+        self._lookup = None  # static list entries by value, only built when searched
+        self._written = None  # keys analysis, only done when asked for
+        self._keys = None
+        self._layer_keys = None
+    # end def __init__()
+
+    def _analyse_keys(self):
+        '''find the keys the combinations can contain (for this plan and below)
+
+        Every key a combination can contain, in layer order, with a marker where
+        a combination is not a dictionary (a raw or simple list value).  Dictionary
+        layers set those values at the position of the element instead.'''
+        written = dict.fromkeys(self._static if self._mode == 'dict' else ())
+        if self._mode == 'raw':
+            written[_RAW_MARK] = None
+        elif self._mode == 'list':
+            for is_nested, entry in self._entries:
+                written.update(dict.fromkeys(entry.written_keys() if is_nested else (_RAW_MARK, )))
+        layer_keys = []  # the keys each dictionary layer can set
+        for pos_key, child_plan in self._nested if self._mode == 'dict' else ():
+            layer_keys.append(frozenset(pos_key if key is _RAW_MARK else key
+                                        for key in child_plan.written_keys()))
+            written.update((pos_key if key is _RAW_MARK else key, None)
+                           for key in child_plan.written_keys())
+        self._layer_keys = tuple(layer_keys)
+        self._keys = tuple(key for key in written if key is not _RAW_MARK)
+        self._written = tuple(written)  # set last: the analysis is complete
+
+    def _find_slots(self):
+        '''locate the layers that are interchangeable slots of the same group'''
+        follows = list(self._follows)
+        groups = []
+        for group in self._interchangeable:
+            members = [layer for layer, (pos_key, dummy) in enumerate(self._nested)
+                       if pos_key in group]
+            if len(members) < 2:
+                continue  # a single slot is just a normal layer
+            first_source = self._nested[members[0]][1].source()
+            for layer in members:
+                if follows[layer] is not None or layer in follows:
+                    raise ValueError('key {!r} is in more than one interchangeable group'.format(
+                        self._nested[layer][0]))
+                if self._nested[layer][1].source() != first_source:
+                    raise ValueError('interchangeable key {!r} has different options'.format(
+                        self._nested[layer][0]))
+            for previous, layer in zip(members, members[1:]):
+                follows[layer] = previous
+            groups.append(tuple(members))
+        self._slot_groups = tuple(groups)
+        self._follows = tuple(follows)
+
+    def _completions(self, layer: int, digits: list) -> int:
+        '''number of ways to fill the layers after layer, with the digits up to layer set
+
+        Free layers multiply.  A group of r slots still to fill, that can not go below
+        option m of n, has (n - m + r - 1) choose r (combinations with replacement).'''
+        in_group = set(itertools.chain.from_iterable(self._slot_groups))
+        total = 1
+        for later in range(layer + 1, len(self._nested)):
+            if later not in in_group:
+                total *= self._nested[later][1].layer_count()
+        for members in self._slot_groups:
+            remaining = sum(1 for member in members if member > layer)
+            if not remaining:
+                continue
+            done = [member for member in members if member <= layer]
+            lowest = digits[done[-1]] if done else 0
+            options = self._nested[members[0]][1].layer_count() - lowest
+            total *= math.comb(options + remaining - 1, remaining)
+        return total
+
+    def interchangeable(self) -> tuple:
+        '''returns the groups of interchangeable dictionary keys the plan was built with'''
+        return self._interchangeable
+
+    def layer_follows(self) -> tuple:
+        '''returns, for each dictionary layer, the previous layer in its slot group (or None)'''
+        return self._follows
+
+    def layer_digits(self, index: int) -> list:
+        '''returns the value index used from each dictionary layer, for a combination index'''
+        digits = [0 for dummy_layer in self._nested]
+        if not self._slot_groups:
+            # the layer indices are mixed radix digits, last layer changing fastest
+            for layer in range(len(self._nested) - 1, -1, -1):
+                index, digits[layer] = divmod(index, self._nested[layer][1].layer_count())
+            return digits
+        for layer, previous in enumerate(self._follows):
+            digits[layer] = 0 if previous is None else digits[previous]
+            while True:  # step past the blocks of combinations for the lower values
+                block = self._completions(layer, digits)
+                if index < block:
+                    break
+                index -= block
+                digits[layer] += 1
+        return digits
+
+    def layer_index(self, digits: list) -> int:
+        '''returns the combination index, from the value index used for each layer'''
+        index = 0
+        if not self._slot_groups:
+            for layer, digit in enumerate(digits):
+                index = index * self._nested[layer][1].layer_count() + digit
+            return index
+        trial = list(digits)
+        for layer, previous in enumerate(self._follows):
+            lowest = 0 if previous is None else digits[previous]
+            for smaller in range(lowest, digits[layer]):
+                trial[layer] = smaller
+                index += self._completions(layer, trial)
+            trial[layer] = digits[layer]
+        return index
+
+    def _valid_digits(self, digits: list) -> bool:
+        '''check that no slot uses an earlier option than the previous slot of its group'''
+        return all(previous is None or digits[previous] <= digit
+                   for digit, previous in zip(digits, self._follows))
+
+    def source(self):
+        '''returns the source object the plan was built from'''
+        return self._context
+
+    def static(self):
+        '''returns a read-only view of the elements that pass through unprocessed'''
+        return self._static
+
+    def nested(self):
+        '''returns (position, child plan) pairs for the elements that need expanding'''
+        return self._nested
+
+    def process_mode(self):
+        '''returns the processing mode: 'dict', 'list' or 'raw' '''
+        return self._mode
+
+    def simple_list(self):
+        '''returns true when no special handling is needed to iterate the source'''
+        # standard iterator breaks when the source is a dictionary: only get keys
+        return not self._nested and self._mode == 'list'
+
+    def empty_list(self):
+        '''returns true when the source is an empty list'''
+        return self._empty
+
+    def count(self):
+        '''returns the number of combinations in a full expansion, without generating any'''
+        return self._count
+
+    def result_keys(self) -> tuple:
+        '''returns every key that a (dictionary) combination can contain'''
+        if self._written is None:
+            self._analyse_keys()
+        return self._keys
+
+    def raw_results(self) -> bool:
+        '''returns true when some combinations are not dictionaries'''
+        return len(self.result_keys()) != len(self._written)
+
+    def layer_keys(self) -> tuple:
+        '''returns the set of keys that each (dictionary) layer can set in a combination'''
+        if self._written is None:
+            self._analyse_keys()
+        return self._layer_keys
+
+    def written_keys(self) -> tuple:
+        '''returns the result keys, with a marker where a combination is not a dictionary'''
+        if self._written is None:
+            self._analyse_keys()
+        return self._written
+
+    def layer_count(self):
+        '''returns the number of values supplied when used as a dictionary layer'''
+        # an empty list still supplies one (empty dictionary) value to merge
+        return 1 if self._empty else self._count
+
+    def __len__(self):
+        '''number of combinations: use count() when that could exceed sys.maxsize'''
+        return self._count
+
+    def __getitem__(self, index):
+        '''return the combination (or list of combinations for a slice) at index
+
+        The same combination that iteration would generate at that position, built
+        directly without generating any of the combinations before it.'''
+        if isinstance(index, slice):
+            return [self._unrank(idx) for idx in range(self._count)[index]]
+        idx = operator.index(index)
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError('combination index {} out of range'.format(index))
+        return self._unrank(idx)
+
+    def sample(self, k: int, seed: object = None) -> list:
+        '''returns k different combinations, picked uniformly at random
+
+        Picks indices (Floyd's algorithm) then builds just those combinations, so the
+        time and memory needed depends on k, not the size of the expansion.  The same
+        seed always gives the same sample.'''
+        if not 0 <= k <= self._count:
+            raise ValueError('sample of {} is larger than the {} combinations'.format(
+                k, self._count))
+        rng = random.Random(seed)
+        picked = set()
+        order = []  # selection sequence, so the result does not depend on set ordering
+        for upper in range(self._count - k, self._count):
+            idx = rng.randrange(upper + 1)
+            if idx in picked:
+                idx = upper
+            picked.add(idx)
+            order.append(idx)
+        rng.shuffle(order)
+        return [self._unrank(idx) for idx in order]
+
+    def random_stream(self, seed: object = None):
+        '''endlessly generate combinations picked (with replacement) uniformly at random'''
+        rng = random.Random(seed)
+        while self._count:
+            yield self._unrank(rng.randrange(self._count))
+
+    def locate_entry(self, index: int) -> tuple:
+        '''returns (list entry index, index within that entry) for a list combination'''
+        # last entry starting at or before index: entries without any combinations
+        # share their start with the following entry, so are never selected
+        entry_idx = bisect.bisect_right(self._starts, index) - 1
+        return (entry_idx, index - self._starts[entry_idx], )
+
+    def _unrank(self, index: int):
+        '''build the combination at (the validated) index'''
+        if self._mode == 'raw':
+            return self._context
+        if self._mode == 'list':
+            entry_idx, offset = self.locate_entry(index)
+            is_nested, entry = self._entries[entry_idx]
+            if is_nested:
+                return entry._unrank(offset)
+            return entry
+        combination = dict(self._static)
+        for (pos_key, child), digit in zip(self._nested, self.layer_digits(index)):
+            if child.empty_list():
+                continue  # merge of empty dictionary is same as original
+            element_value = child._unrank(digit)
+            if isinstance(element_value, dict):
+                combination.update(element_value)
+            else:
+                combination[pos_key] = element_value
+        return combination
+
+    def indices_of(self, combination: object) -> list:
+        '''returns the index of every position where combination is generated
+
+        Found by matching against the structure, working back through the cascade,
+        without generating the expansion.  The list is empty when combination is
+        never generated, and has multiple entries when it is generated more than once.'''
+        return sorted(self._ranks(combination))
+
+    def index_of(self, combination: object) -> int:
+        '''returns the first index where combination is generated; ValueError if never'''
+        indices = self.indices_of(combination)
+        if not indices:
+            raise ValueError('{!r} is not generated by the expansion'.format(combination))
+        return indices[0]
+
+    def __contains__(self, combination: object) -> bool:
+        '''check if combination is generated by the expansion, without generating it'''
+        for dummy_idx in self._ranks(combination):
+            return True
+        return False
+
+    def project(self, keys: object) -> list:
+        '''returns the distinct values of keys (as dictionaries) over every combination
+
+        Worked out from the structure, without generating the expansion.  Layers that
+        can not set any of the keys are skipped (only whether they have any values at
+        all matters), and later layers override earlier ones, the same as the cascade.
+        Each projection holds the keys present in a combination, in the order of keys.
+        They are listed in the order they first appear in the expansion.'''
+        keys = tuple(keys)
+        if self.raw_results():
+            raise ValueError('only dictionary combinations can be projected')
+        return [{key: found[key] for key in keys if key in found}
+                for found in self._fragments(frozenset(keys), None, {})]
+
+    def histogram(self, key: object) -> Counter:
+        '''returns the number of combinations with each value of key
+
+        Calculated from the structure, without generating the expansion: list entries
+        add, and dictionary layers multiply.  A layer that sets key overrides the
+        value from the static values and earlier layers, the same as the cascade.
+        Combinations without key are counted as MISSING.  A value that is not
+        hashable is counted by its hashable_form.'''
+        if self.raw_results():
+            raise ValueError('only dictionary combinations have keys to count')
+        found, unset = self._value_counts(key, None, {})
+        counts = Counter({value_key: count for value_key, (dummy_value, count) in found.items()
+                          if count})
+        if unset:
+            counts[MISSING] = unset
+        return counts
+
+    def aggregate(self, keys: object = None) -> dict:
+        '''returns the histogram for each of keys (default: every result key)'''
+        return {key: self.histogram(key)
+                for key in (self.result_keys() if keys is None else keys)}
+
+    def _value_counts(self, key: object, pos_key: object, memo: dict) -> tuple:
+        '''returns ({value key: [value, count]}, count without key) for this plan
+
+        pos_key is the dictionary key a (non dictionary) value is set at, when this
+        plan is a dictionary layer.  memo holds the results for shared child plans.'''
+        memo_key = (id(self), pos_key, )
+        if memo_key in memo:
+            return memo[memo_key]
+        found = {}
+        if self._mode == 'list':
+            unset = 0
+            for is_nested, entry in self._entries:
+                if is_nested:
+                    entry_found, entry_unset = entry._value_counts(key, pos_key, memo)
+                    for value_key, (value, count) in entry_found.items():
+                        found.setdefault(value_key, [value, 0])[1] += count
+                    unset += entry_unset
+                elif pos_key == key:
+                    found.setdefault(hashable_form(entry), [entry, 0])[1] += 1
+                else:
+                    unset += 1
+        else:
+            if any(follows is not None for follows in self._follows):
+                raise ValueError('histograms are not available for interchangeable slots')
+            unset = 1
+            if key in self._static:
+                found[hashable_form(self._static[key])] = [self._static[key], 1]
+                unset = 0
+            total = 1  # combinations of the layers so far
+            for child_pos, child_plan in self._nested:
+                layer_total = child_plan.layer_count()
+                written = child_plan.written_keys()
+                if key in written or (key == child_pos and _RAW_MARK in written):
+                    child_found, child_unset = child_plan._value_counts(key, child_pos, memo)
+                else:
+                    child_found, child_unset = {}, layer_total
+                # an earlier value is only kept when this layer does not set key
+                found = {value_key: [value, count * child_unset]
+                         for value_key, (value, count) in found.items()}
+                unset *= child_unset
+                for value_key, (value, count) in child_found.items():
+                    found.setdefault(value_key, [value, 0])[1] += count * total
+                total *= layer_total
+        memo[memo_key] = (found, unset, )
+        return memo[memo_key]
+
+    def gray_code(self):
+        '''generate every combination, ordered so consecutive ones differ as little as possible
+
+        A reflected (mixed radix) Gray code over the dictionary layers: each step
+        changes the value of a single layer, to the neighbouring value in the Gray code
+        order of that layer (so nested dictionaries change as little as possible too).
+        List entries are still taken in order.  Not available with interchangeable
+        slots, where the layer values are not independent.'''
+        if self._has_slots(set()):
+            raise ValueError('minimal change order is not available for interchangeable '
+                             'slots')
+        for index in range(self._count):
+            yield self._gray_unrank(index)
+
+    def deltas(self, gray: bool = True):
+        '''generate the changes from each combination to the next, as dictionaries
+
+        The first is the whole first combination.  Each one after that holds only the
+        keys with a new value, plus MISSING for any key the combination no longer has.
+        Applying the changes in turn rebuilds every combination.  The combinations are
+        in minimal change (gray_code) order, or the normal expansion order.'''
+        if self.raw_results():
+            raise ValueError('only dictionary combinations can be compared by key')
+        previous = {}
+        for combination in (self.gray_code() if gray else iter(self)):
+            change = {key: value for key, value in combination.items()
+                      if key not in previous or previous[key] != value}
+            change.update((key, MISSING) for key in previous if key not in combination)
+            yield change
+            previous = combination
+
+    def added_since(self, old: object):
+        '''generate (in expansion order) the combinations that old does not generate
+
+        old is the plan (or specification) before a change.  The two structures are
+        compared, so only the parts that changed are expanded: list entries equal to
+        an old entry are skipped, and for a dictionary with the same static values and
+        layers, only the combinations using a layer value that the old layer does not
+        have are looked at.  Each of those is checked against the old structure (the
+        same as in), without generating the old expansion.'''
+        if not isinstance(old, ExpansionPlan):
+            old = ExpansionPlan(old, self._interchangeable)
+        for index in self._added_indices(old, {}):
+            yield self._unrank(index)
+
+    def _added_indices(self, old: 'ExpansionPlan', memo: dict):
+        '''generate (in order) the indices of the combinations that old does not generate'''
+        for index in self._changed_indices(old, memo):
+            if self._unrank(index) not in old:
+                yield index
+
+    def _changed_indices(self, old: 'ExpansionPlan', memo: dict):
+        '''generate (in order) the indices of combinations that could be new, since old
+
+        Every combination old does not generate is included, but some of them may
+        still be generated by old (a changed value that is replaced later).'''
+        if self._context is old._context or (
+                self._mode == old._mode and self._interchangeable == old._interchangeable and
+                self._context == old._context):
+            return
+        if self._mode != old._mode or self._mode == 'raw':
+            yield from range(self._count)
+            return
+        if self._mode == 'list':
+            old_sources = [entry.source() for is_nested, entry in old._entries if is_nested]
+            old_statics = [entry for is_nested, entry in old._entries if not is_nested]
+            for entry_idx, (is_nested, entry) in enumerate(self._entries):
+                start = self._starts[entry_idx]
+                if not is_nested:
+                    if entry not in old_statics:
+                        yield start
+                    continue
+                if entry.source() in old_sources:
+                    continue  # the same entry (moved or not) generates the same combinations
+                if entry_idx < len(old._entries) and old._entries[entry_idx][0]:
+                    # changed in place: compare with the old version of the entry
+                    old_entry = old._entries[entry_idx][1]
+                    yield from (start + idx for idx in entry._changed_indices(old_entry, memo))
+                else:
+                    yield from range(start, start + entry.count())
+            return
+        if (self._slot_groups or old._slot_groups or dict(self._static) != dict(old._static) or
+                [pos_key for pos_key, dummy in self._nested] !=
+                [pos_key for pos_key, dummy in old._nested]):
+            yield from range(self._count)
+            return
+        # same keys and layers: a combination built only from values the old layers also
+        # have is generated by old, so at least one layer has to use a new value
+        changed = []  # the new values (indices) for each layer
+        for (dummy_pos, child), (dummy_old_pos, old_child) in zip(self._nested, old._nested):
+            if child.empty_list() or old_child.empty_list():
+                changed.append(set() if child.empty_list() and old_child.empty_list() else
+                               set(range(child.layer_count())))
+                continue
+            memo_key = (id(child), id(old_child), )
+            if memo_key not in memo:
+                memo[memo_key] = set(child._added_indices(old_child, memo))
+            changed.append(memo[memo_key])
+        later_changes = [False] * (len(changed) + 1)
+        for layer in range(len(changed) - 1, -1, -1):
+            later_changes[layer] = later_changes[layer + 1] or bool(changed[layer])
+        blocks = [1] * (len(changed) + 1)  # combinations for each value of a layer
+        for layer in range(len(changed) - 1, -1, -1):
+            blocks[layer] = blocks[layer + 1] * self._nested[layer][1].layer_count()
+
+        def search(layer: int, base: int):
+            '''walk the layer values in order, until a new value has been used'''
+            if not later_changes[layer]:
+                return
+            radix = self._nested[layer][1].layer_count()
+            for digit in range(radix):
+                index = base + digit * blocks[layer + 1]
+                if digit in changed[layer]:
+                    yield from range(index, index + blocks[layer + 1])
+                else:
+                    yield from search(layer + 1, index)
+        yield from search(0, 0)
+
+    def encodings(self):
+        '''generate a tuple of small integers for each combination, in expansion order
+
+        Each tuple holds one choice for every decision made while building the
+        combination, in the order they are made: the entry used from each list, with
+        the choices for a nested entry following its own index.  Dictionary layers add
+        their choices in layer order, and fixed values add nothing.  decode turns a
+        tuple back into the combination.  Sorting the tuples gives expansion order.'''
+        yield from self._encodings()
+
+    def _encodings(self):
+        '''generate the index tuples for this plan'''
+        if self._mode == 'raw':
+            yield ()
+            return
+        if self._mode == 'list':
+            for entry_idx, (is_nested, entry) in enumerate(self._entries):
+                if not is_nested:
+                    yield (entry_idx, )
+                    continue
+                for codes in entry._encodings():
+                    yield (entry_idx, ) + codes
+            return
+        digits = [0 for dummy_layer in self._nested]
+
+        def fill(layer: int, prefix: tuple):
+            '''add the choices for each value of a layer, then the layers after it'''
+            if layer == len(self._nested):
+                yield prefix
+                return
+            child_plan = self._nested[layer][1]
+            if child_plan.empty_list():  # merges an empty dictionary: nothing to choose
+                yield from fill(layer + 1, prefix)
+                return
+            previous = self._follows[layer]
+            if previous is None:
+                parts = enumerate(child_plan._encodings())
+            else:  # an interchangeable slot never goes back before the previous slot
+                parts = ((digit, child_plan.encoding(digit))
+                         for digit in range(digits[previous], child_plan.count()))
+            for digits[layer], codes in parts:
+                yield from fill(layer + 1, prefix + codes)
+        yield from fill(0, ())
+
+    def encoding(self, index: int) -> tuple:
+        '''returns the index tuple (see encodings) for the combination at index'''
+        idx = operator.index(index)
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError('combination index {} out of range'.format(index))
+        return self._encode(idx)
+
+    def _encode(self, index: int) -> tuple:
+        '''build the index tuple for (the validated) index'''
+        if self._mode == 'raw':
+            return ()
+        if self._mode == 'list':
+            entry_idx, offset = self.locate_entry(index)
+            is_nested, entry = self._entries[entry_idx]
+            return (entry_idx, ) + (entry._encode(offset) if is_nested else ())
+        codes = ()
+        for (dummy_pos, child), digit in zip(self._nested, self.layer_digits(index)):
+            if not child.empty_list():
+                codes += child._encode(digit)
+        return codes
+
+    def decode(self, codes: tuple):
+        '''returns the combination for an index tuple (see encodings)
+
+        The same combination that iteration generates, built directly from the
+        choices, so the tuples can be stored or sent instead of the combinations.'''
+        codes = tuple(codes)
+        combination, used = self._decode(codes, 0)
+        if used != len(codes):
+            raise ValueError('index tuple {!r} has more choices than needed'.format(codes))
+        return combination
+
+    def _decode(self, codes: tuple, pos: int) -> tuple:
+        '''returns (combination, position after the choices used) for codes from pos'''
+        if self._mode == 'raw':
+            return self._context, pos
+        if self._mode == 'list':
+            if pos >= len(codes):
+                raise ValueError('index tuple {!r} has too few choices'.format(codes))
+            entry_idx = operator.index(codes[pos])
+            if not 0 <= entry_idx < len(self._entries):
+                raise ValueError('choice {} is not an entry of the list, in {!r}'.format(
+                    entry_idx, codes))
+            is_nested, entry = self._entries[entry_idx]
+            if is_nested:
+                return entry._decode(codes, pos + 1)
+            return entry, pos + 1
+        combination = dict(self._static)
+        for pos_key, child in self._nested:
+            if child.empty_list():
+                continue  # merge of empty dictionary is same as original
+            element_value, pos = child._decode(codes, pos)
+            if isinstance(element_value, dict):
+                combination.update(element_value)
+            else:
+                combination[pos_key] = element_value
+        return combination, pos
+
+    def _has_slots(self, checked: set) -> bool:
+        '''check if this plan, or any plan below it, has interchangeable slots'''
+        if id(self) in checked:
+            return False
+        checked.add(id(self))
+        return bool(self._slot_groups) or any(
+            child_plan._has_slots(checked) for dummy_pos, child_plan in self._nested)
+
+    def _gray_unrank(self, index: int):
+        '''build the combination at (the validated) index of the minimal change order'''
+        if self._mode == 'raw':
+            return self._context
+        if self._mode == 'list':
+            entry_idx, offset = self.locate_entry(index)
+            is_nested, entry = self._entries[entry_idx]
+            if is_nested:
+                return entry._gray_unrank(offset)
+            return entry
+        digits = [0 for dummy_layer in self._nested]
+        for layer in range(len(self._nested) - 1, -1, -1):
+            radix = self._nested[layer][1].layer_count()
+            index, digit = divmod(index, radix)
+            # reflected: every other pass over this layer runs backwards, so the digit
+            # does not change when a higher (slower) layer moves to its next value
+            digits[layer] = digit if index % 2 == 0 else radix - 1 - digit
+        combination = dict(self._static)
+        for (pos_key, child), digit in zip(self._nested, digits):
+            if child.empty_list():
+                continue  # merge of empty dictionary is same as original
+            element_value = child._gray_unrank(digit)
+            if isinstance(element_value, dict):
+                combination.update(element_value)
+            else:
+                combination[pos_key] = element_value
+        return combination
+
+    def _fragments(self, wanted: frozenset, pos_key: object, memo: dict) -> list:
+        '''returns the distinct parts of the wanted keys set by this plan, at pos_key
+
+        pos_key is the dictionary key a (non dictionary) value is set at, when this
+        plan is a dictionary layer.  memo holds the results for shared child plans.'''
+        memo_key = (id(self), pos_key, )
+        if memo_key in memo:
+            return memo[memo_key]
+        if self._mode == 'list':
+            found = {}
+            for is_nested, entry in self._entries:
+                if is_nested:
+                    parts = entry._fragments(wanted, pos_key, memo)
+                else:
+                    parts = [{pos_key: entry} if pos_key in wanted else {}]
+                for part in parts:
+                    found.setdefault(hashable_form(part), part)
+        elif not self._count:
+            found = {}
+        else:
+            slots = {layer for layer, follows in enumerate(self._follows)
+                     if follows is not None} | set(self._follows)
+            partial = {key: value for key, value in self._static.items() if key in wanted}
+            found = {hashable_form(partial): partial}
+            for layer, (child_pos, child_plan) in enumerate(self._nested):
+                if wanted.isdisjoint(child_pos if key is _RAW_MARK else key
+                                     for key in child_plan.written_keys()):
+                    continue  # can not change the projection: skip the whole subtree
+                if layer in slots:
+                    raise ValueError('projections are not available for interchangeable '
+                                     'slots')
+                parts = child_plan._fragments(wanted, child_pos, memo)
+                merged = {}
+                for partial in found.values():
+                    for part in parts:  # later layers override: the cascade
+                        combined = dict(partial)
+                        combined.update(part)
+                        merged.setdefault(hashable_form(combined), combined)
+                found = merged
+        memo[memo_key] = list(found.values())
+        return memo[memo_key]
+
+    def _ranks(self, target: object):
+        '''generate the (unordered) indices of the combinations equal to target'''
+        if self._mode == 'raw':
+            if self._context == target:
+                yield 0
+        elif self._mode == 'list':
+            for entry_idx in self._static_entries(target):
+                yield self._starts[entry_idx]
+            for entry_idx, child in self._nested:
+                for idx in child._ranks(target):
+                    yield self._starts[entry_idx] + idx
+        elif isinstance(target, Mapping):
+            target_keys = set(target)
+            for idx, written in self._dict_matches(target, frozenset()):
+                if written == target_keys:  # nothing missing, and nothing extra
+                    yield idx
+
+    def _layer_matches(self, target: Mapping, covered: frozenset, pos_key: object):
+        '''generate (index, keys written) for each value that fits target as a layer
+
+        Keys in covered get replaced later in the cascade, so any value for those
+        is fine.  Every other key written has to have the target value.'''
+        if self._mode == 'dict':
+            yield from self._dict_matches(target, covered)
+            return
+        position_written = frozenset((pos_key, ))
+        if pos_key in covered:
+            statics = [idx for idx, (is_nested, dummy) in enumerate(self._entries)
+                       if not is_nested]
+        elif pos_key in target:
+            statics = self._static_entries(target[pos_key])
+        else:
+            statics = []
+        for entry_idx in statics:
+            yield self._starts[entry_idx], position_written
+        for entry_idx, child in self._nested:
+            for idx, written in child._layer_matches(target, covered, pos_key):
+                yield self._starts[entry_idx] + idx, written
+
+    def _dict_matches(self, target: Mapping, covered: frozenset):
+        '''generate (index, keys written) for the dictionary combinations that fit target'''
+        digits = [0 for dummy_pos in self._nested]
+
+        def search(layer: int, cover: frozenset, written: frozenset):
+            '''work back through the layers, since the final value is from the last write'''
+            if layer < 0:
+                for key, value in self._static.items():
+                    if key not in cover and (key not in target or target[key] != value):
+                        return
+                if self._valid_digits(digits):
+                    yield self.layer_index(digits), written.union(self._static)
+                return
+            pos_key, child = self._nested[layer]
+            if child.empty_list():
+                matches = [(0, frozenset(), )]  # merge of empty dictionary changes nothing
+            else:
+                matches = child._layer_matches(target, cover, pos_key)
+            for digits[layer], child_written in matches:
+                yield from search(layer - 1, cover | child_written, written | child_written)
+        return search(len(self._nested) - 1, covered, frozenset())
+
+    def _static_entries(self, value: object) -> list:
+        '''returns the indices of the static list entries equal to value'''
+        if self._lookup is None:
+            lookup = {}
+            unhashable = []
+            for entry_idx, (is_nested, entry) in enumerate(self._entries):
+                if is_nested:
+                    continue
+                try:
+                    lookup.setdefault(entry, []).append(entry_idx)
+                except TypeError:  # tuple holding a list, or similar: has to be scanned
+                    unhashable.append(entry_idx)
+            self._lookup = (lookup, unhashable, )
+        lookup, unhashable = self._lookup
+        try:
+            found = list(lookup.get(value, []))
+        except TypeError:
+            found = []
+        found.extend(idx for idx in unhashable if self._entries[idx][1] == value)
+        return found
+
+    def __iter__(self):
+        '''return a new, independent, iterator over all of the combinations'''
+        return iter(ExpandCombinations(self))
+
+    def cache(self):
+        '''returns the cache of child plans shared while analysing this plan'''
+        return self._cache
+
+    def materialised(self):
+        '''returns all of the combinations, when there are few enough to keep
+
+        Generated the first time this is needed, then kept with the plan, so every
+        iterator (and every restart) for a shared plan just walks the saved tuple.
+        The combinations must not be modified.  None when the expansion is large.'''
+        if self._materialised is None:
+            if self._count > self._cache.materialise_limit():
+                return None
+            self._materialised = tuple(ExpandCombinations(self))
+        return self._materialised
+# end class ExpansionPlan()
+
+
+class PlanCache(object):
+    '''bounded cache of analysed plans, by source object identity
+
+    The least recently used plan is dropped when the cache is full.  Plans with up to
+    materialise combinations also keep those combinations (see materialised).  Plans
+    keep a reference to their source, so an identity is never reused for a different
+    object while it is cached.  The source objects must not be modified.'''
+
+    def __init__(self, maxsize: int = 1024, materialise: int = 64):
+        self._plans = OrderedDict()
+        self._maxsize = maxsize
+        self._materialise = materialise
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def plan(self, source: object, interchangeable: tuple = ()):
+        '''returns the (cached) plan for source'''
+        key = (id(source), interchangeable, )
+        cached = self._plans.get(key)
+        if cached is not None and cached.source() is source:
+            self._plans.move_to_end(key)
+            self._stats['hits'] += 1
+            return cached
+        self._stats['misses'] += 1
+        cached = ExpansionPlan(source, interchangeable, self)
+        self._plans[key] = cached
+        if len(self._plans) > self._maxsize:
+            self._plans.popitem(last=False)
+            self._stats['evictions'] += 1
+        return cached
+
+    def materialise_limit(self) -> int:
+        '''returns the largest number of combinations kept with a plan'''
+        return self._materialise
+
+    def stats(self) -> dict:
+        '''returns hit, miss and eviction counts, and the current number of plans'''
+        return dict(self._stats, size=len(self._plans), maxsize=self._maxsize)
+
+    def clear(self):
+        '''forget every cached plan (the statistics are kept)'''
+        self._plans.clear()
+# end class PlanCache()
+
+
+class Constraint(object):
+    '''a rule that every generated combination must satisfy
+
+    predicate is called with a (partial) combination, and returns true when that is
+    allowed.  keys lists every key the predicate looks at.  The rule is checked as
+    soon as no later layer can set any of those keys, so every combination that would
+    build on a rejected partial combination is skipped without being generated.  A
+    key that is not in the partial combination at that point is not in the final
+    combination either.  Without keys, the rule is checked on complete combinations.'''
+
+    def __init__(self, predicate, keys: object = None):
+        self._predicate = predicate
+        self._keys = None if keys is None else frozenset(keys)
+
+    def keys(self):
+        '''returns the keys the predicate looks at, or None when it could be any'''
+        return self._keys
+
+    def __call__(self, combination: object) -> bool:
+        return bool(self._predicate(combination))
+# end class Constraint()
+
+
+def _rule_matches(rule: dict, combination: object) -> bool:
+    '''check if every key in rule is in combination, with (one of) the rule value(s)'''
+    for key, allowed in rule.items():
+        if key not in combination:
+            return False
+        if isinstance(allowed, (list, set, frozenset)):  # any of several values
+            if combination[key] not in allowed:
+                return False
+        elif combination[key] != allowed:
+            return False
+    return True
+
+
+def exclude(rule: dict) -> Constraint:
+    '''constraint that rejects combinations matching every key of rule
+
+    A rule value that is a list (or set) matches any of the values in it.
+    exclude({'wine': 'red', 'entrée': ['white fish', 'rainbow trout']})'''
+    rule = dict(rule)
+    return Constraint(lambda combination: not _rule_matches(rule, combination), rule)
+
+
+def include(rule: dict, when: dict = None) -> Constraint:
+    '''constraint that only allows combinations matching every key of rule
+
+    With when, only combinations that match when have to match rule as well.
+    include({'package': 'SOT23'}, when={'mounting': 'SMD'})'''
+    rule = dict(rule)
+    when = dict(when or {})
+    return Constraint(lambda combination: (not _rule_matches(when, combination) or
+                                           _rule_matches(rule, combination)),
+                      set(rule) | set(when))
+
+
+# private marker for a combination that is not a dictionary, in the plan written keys
+_RAW_MARK = object()
+
+# private markers, so that converted lists and dictionaries can not match any real tuple
+_LIST_MARK = object()
+_MAPPING_MARK = object()
+
+
+def hashable_form(value: object) -> object:
+    '''returns a hashable equivalent of value: equal values give equal results
+
+    Lists (also nested inside tuples), dictionaries and sets are converted to
+    hashable structures, so that combinations can be collected in sets and dicts.'''
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        pass
+    if isinstance(value, Mapping):
+        return (_MAPPING_MARK, frozenset((key, hashable_form(val)) for key, val in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(hashable_form(element) for element in value)
+    if isinstance(value, tuple):
+        return tuple(hashable_form(element) for element in value)
+    return (_LIST_MARK, tuple(hashable_form(element) for element in value))
+
+
+def unique_key(keys: object = None, unordered: bool = False):
+    '''returns a function giving the identity of a combination, for removing repeats
+
+    The identity covers only the (present) keys listed in keys, or the whole
+    combination when keys is None.  With unordered, it is the multiset of those
+    values, ignoring which key each came from: first='feta', second='bacon' is
+    then the same as first='bacon', second='feta'.'''
+    if keys is not None:
+        keys = tuple(keys)
+
+    def identity(combination: object) -> object:
+        '''hashable identity for the selected part of a combination'''
+        if not isinstance(combination, Mapping):
+            return hashable_form(combination)
+        selected = combination.keys() if keys is None else [
+            key for key in keys if key in combination]
+        if unordered:
+            return frozenset(Counter(
+                hashable_form(combination[key]) for key in selected).items())
+        return frozenset((key, hashable_form(combination[key])) for key in selected)
+    return identity
+
+
+def expansion_diff(old: object, new: object, removed: bool = False,
+                   interchangeable: object = None):
+    '''generate ('+', combination) for each combination added by changing old to new
+
+    Then, with removed, ('-', combination) for each combination old generates that
+    new does not.  old and new are specifications or plans.  The structures are
+    compared (see ExpansionPlan.added_since), so neither expansion is generated
+    in full.'''
+    if not isinstance(old, ExpansionPlan):
+        old = ExpansionPlan(old, interchangeable)
+    if not isinstance(new, ExpansionPlan):
+        new = ExpansionPlan(new, interchangeable)
+    for combination in new.added_since(old):
+        yield '+', combination
+    if removed:
+        for combination in old.added_since(new):
+            yield '-', combination
+
+
+# per worker process state for parallel_map: the expansion is analysed once per process
+_WORKER_STATE = {}
+
+
+def _init_worker(func, spec, interchangeable):
+    '''process pool initializer: keep the function, and the analysed expansion plan'''
+    _WORKER_STATE['func'] = func
+    _WORKER_STATE['plan'] = ExpansionPlan(spec, interchangeable)
+
+
+def _map_range(start: int, stop: int) -> list:
+    '''worker task: apply the function to every combination in an index range'''
+    func = _WORKER_STATE['func']
+    return [func(combination) for combination in
+            ExpandCombinations(_WORKER_STATE['plan'], start=start, stop=stop)]
+
+
+def parallel_map(func, spec: object, workers: int = None, chunksize: int = 1000,
+                 ordered: bool = True, max_pending: int = None):
+    '''apply func to every combination of spec, using a pool of worker processes
+
+    Each worker analyses spec once, then generates its own combinations from the
+    index ranges (chunks) it is given, so only the spec and the function results
+    get sent between processes.  No more than max_pending chunks (default: two per
+    worker) are in flight at any time, to keep memory flat.  Results are yielded
+    in expansion order when ordered, otherwise as soon as each chunk finishes.'''
+    if not isinstance(spec, ExpansionPlan):
+        spec = ExpansionPlan(spec)
+    if chunksize < 1:
+        raise ValueError('chunksize must be at least 1, not {!r}'.format(chunksize))
+    total = spec.count()
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    chunks = ((start, min(start + chunksize, total), ) for start in range(0, total, chunksize))
+    # plans are not sent to the workers: each builds its own from the source
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(func, spec.source(), spec.interchangeable(), ))
+    try:
+        pending = deque()
+        while True:
+            for bounds in itertools.islice(chunks, max_pending - len(pending)):
+                pending.append(pool.submit(_map_range, *bounds))
+            if not pending:
+                break
+            if ordered:
+                yield from pending.popleft().result()
+                continue
+            finished, dummy_running = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                pending.remove(future)
+                yield from future.result()
+    finally:
+        # do not wait for chunks nobody is going to see, when the caller stops early
+        pool.shutdown(cancel_futures=True)
+# end def parallel_map()
+
+
+_WRITE_BLOCK = 4096  # combinations encoded (and written) together
+_BUFFER_SIZE = 1 << 20
+
+
+def _read_spec(path: str) -> object:
+    '''returns the specification to expand, from a JSON or YAML file (or stdin)'''
+    if path == '-':
+        text = sys.stdin.read()
+    else:
+        with open(path, encoding='utf-8') as spec_file:
+            text = spec_file.read()
+    if not path.endswith(('.yaml', '.yml')):
+        try:
+            return json.loads(text)
+        except ValueError:
+            if yaml is None or path != '-':
+                raise
+    if yaml is None:
+        raise ValueError('PyYAML is needed to read YAML specifications')
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError as exc:
+        raise ValueError('specification is not valid JSON or YAML: {}'.format(exc)) from exc
+
+
+def _open_output(path: str, compressed: bool):
+    '''returns a large buffered text stream for the output file (or stdout)'''
+    if compressed:  # fast compression: the output is usually much larger than the input
+        binary = io.BufferedWriter(gzip.GzipFile(
+            None if path == '-' else path, 'wb', compresslevel=1,
+            fileobj=sys.stdout.buffer if path == '-' else None), _BUFFER_SIZE)
+    elif path == '-':
+        binary = open(sys.stdout.fileno(), 'wb', buffering=_BUFFER_SIZE, closefd=False)
+    else:
+        binary = open(path, 'wb', buffering=_BUFFER_SIZE)
+    return io.TextIOWrapper(binary, encoding='utf-8', newline='')
+
+
+def _flat_product(plan: ExpansionPlan, encode, separator: str):
+    '''returns the encoded values to join for each combination, or None
+
+    Only for a dictionary of simple lists: then every value is encoded just once,
+    and the text for each combination is the join of one value from each list
+    (static values first, the same as the dictionary).'''
+    nested = plan.nested()
+    if not (plan.process_mode() == 'dict' and nested and
+            all(child_plan.simple_list() for dummy_key, child_plan in nested) and
+            all(follows is None for follows in plan.layer_follows())):
+        return None
+    encoded = [[encode(pos_key, value) for value in child_plan.source()]
+               for pos_key, child_plan in nested if not child_plan.empty_list()]
+    if plan.static():
+        encoded.insert(0, [separator.join(encode(key, value)
+                                          for key, value in plan.static().items())])
+    return encoded
+
+
+def _write_jsonl(plan: ExpansionPlan, start: int, stop: int, output):
+    '''write each combination as a single line of JSON'''
+    encode = json.JSONEncoder(ensure_ascii=False, check_circular=False, default=str).encode
+    encoded = _flat_product(plan, lambda key, value: encode({key: value})[1:-1], ', ')
+    if encoded is None:
+        lines = map(encode, ExpandCombinations(plan, start=start, stop=stop))
+    else:
+        lines = map('{{{}}}'.format, map(', '.join, itertools.islice(
+            itertools.product(*encoded), start, stop)))
+    for block in iter(lambda: list(itertools.islice(lines, _WRITE_BLOCK)), []):
+        output.write('\n'.join(block))
+        output.write('\n')
+
+
+def _csv_field(dummy_key, value) -> str:
+    '''returns value encoded (and quoted when needed) as a single CSV field'''
+    if value is None or (isinstance(value, str) and not value):
+        return ''  # a row with only an empty field is written as "", not as a blank
+    field = io.StringIO()
+    csv.writer(field, lineterminator='\n').writerow([value])
+    return field.getvalue()[:-1]
+
+
+def _write_csv(plan: ExpansionPlan, start: int, stop: int, output):
+    '''write the combinations as CSV rows, with a column for every possible key'''
+    if plan.raw_results() or not plan.result_keys():  # check before writing anything
+        raise ValueError('CSV output needs combinations that are all dictionaries with keys')
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(plan.result_keys())
+    encoded = _flat_product(plan, _csv_field, ',')
+    if encoded is not None:
+        rows = map(','.join, itertools.islice(itertools.product(*encoded), start, stop))
+        for block in iter(lambda: list(itertools.islice(rows, _WRITE_BLOCK)), []):
+            output.write('\n'.join(block))
+            output.write('\n')
+        return
+    walker = ExpandCombinations(plan, start=start, stop=stop, layered=True)
+    for batch in walker.batches(_WRITE_BLOCK):
+        columns = [['' if value is MISSING else value for value in column]
+                   for column in batch.values()]
+        writer.writerows(zip(*columns))
+
+
+def main(argv: list = None) -> int:
+    '''expand a JSON (or YAML) specification, streaming the combinations'''
+    parser = argparse.ArgumentParser(
+        prog='python -m expand_combinations',
+        description='Expand the combinations described by nested dictionaries and lists.')
+    parser.add_argument('spec', nargs='?', default='-',
+                        help='JSON or YAML specification file (default: stdin)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: stdout)')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv', 'jsonl.gz'],
+                        help='output format (default: from the output file name, or jsonl)')
+    parser.add_argument('--count', action='store_true',
+                        help='only show the number of combinations that would be generated')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='skip this many combinations (without generating them)')
+    parser.add_argument('--limit', type=int,
+                        help='generate at most this many combinations')
+    parser.add_argument('--shard', metavar='K/N',
+                        help='only generate the K-th (from 0) of N blocks of combinations')
+    parser.add_argument('--interchangeable', metavar='KEY,KEY…', action='append',
+                        help='comma separated group of interchangeable slot keys')
+    args = parser.parse_args(argv)
+
+    output_format = args.format
+    if output_format is None:
+        output_format = 'jsonl'
+        if args.output.endswith('.gz'):
+            output_format = 'jsonl.gz'
+        elif args.output.endswith('.csv'):
+            output_format = 'csv'
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = tuple(int(part) for part in args.shard.split('/'))
+        except ValueError:
+            parser.error('--shard must be K/N, not {!r}'.format(args.shard))
+        if len(shard) != 2:
+            parser.error('--shard must be K/N, not {!r}'.format(args.shard))
+    if args.offset < 0 or (args.limit is not None and args.limit < 0):
+        parser.error('--offset and --limit can not be negative')
+
+    try:
+        plan = ExpansionPlan(_read_spec(args.spec), [
+            group.split(',') for group in args.interchangeable or ()])
+        # the block to generate: the shard (or everything), then the offset and limit
+        start, stop = _range_bounds(plan.count(), shard, None, None)
+        start = min(start + args.offset, stop)
+        if args.limit is not None:
+            stop = min(stop, start + args.limit)
+        if args.count:
+            print(stop - start)
+            return 0
+        output = _open_output(args.output, output_format == 'jsonl.gz')
+        try:
+            (_write_csv if output_format == 'csv' else _write_jsonl)(plan, start, stop, output)
+        finally:
+            output.close()
+        if args.output == '-':
+            sys.stdout.flush()
+    except BrokenPipeError:  # stopped reading (like piping to head)
+        # python would report the (unflushable) stdout again while shutting down
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    except (OSError, ValueError) as exc:
+        parser.exit(1, '{}: error: {}\n'.format(parser.prog, exc))
+    return 0
+
+
 # Standalone module execution
 if __name__ == "__main__":
-    print('see "samples.py" for code to exercise the class')
+    sys.exit(main())
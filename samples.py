@@ -17,9 +17,8 @@ import sys
 from expand_combinations import ExpandCombinations
 
 
-def mymain(*supplied_keys):
-    '''wrapper for test/start code so that variables do not look like constants'''
-    smpl_keys = supplied_keys
+def sample_specs():
+    '''returns the sample input data, by name'''
     samples = {
         's1': {'key1': 'constant value', 'key2': ['option 1', 'option 2', ], },
         's2': {'key1': 'constant value', 'key2': ['option 1', 'option 2', ],
@@ -116,6 +115,13 @@ def mymain(*supplied_keys):
         'toppings': (cheeses, meats)
     }
     # print(samples['pizza2'])  # DEBUG
+    return samples
+
+
+def mymain(*supplied_keys):
+    '''wrapper for test/start code so that variables do not look like constants'''
+    smpl_keys = supplied_keys
+    samples = sample_specs()
 
     if len(sys.argv) > 1:
         smpl_keys = sys.argv[1:]
@@ -128,30 +134,24 @@ def mymain(*supplied_keys):
         print('\nsample {} input data:'.format(smpl))
         print(samples[smpl])
         test_iter = ExpandCombinations(samples[smpl])
-        dedup = []  # only used for pizza
         print('sample {} expanded outputs:'.format(smpl))
         expansion_count = 0
         for cmb in test_iter:
             expansion_count += 1
             print(cmb)
-            # pizza is special.  Get the unique topping Combinations
-            if smpl == 'pizza':
-                cmb_toppings = []
-                for pkey in pizza_keys:
-                    if pkey in cmb:
-                        cmb_toppings.append(cmb[pkey])
-                cmb_toppings.sort()
-                if cmb_toppings not in dedup:
-                    dedup.append(cmb_toppings)
         print('{} expanded combinations'.format(expansion_count))
+        # pizza is special.  Get the unique topping Combinations
         if smpl == 'pizza':
-            for cmb in dedup:
-                print(cmb)
-            print('{} unique pizza topping combinations'.format(len(dedup)))
+            unique_count = 0
+            for cmb in ExpandCombinations(samples[smpl], interchangeable=[pizza_keys]):
+                unique_count += 1
+                print(sorted(cmb.values()))
+            print('{} unique pizza topping combinations'.format(unique_count))
 
 
 # Specify the sample(s) to show on the command line, or hard-code string value
 # arguments.  Any command line arguments override the hard-coded strings
 # mymain()
 # mymain('dup1')
-mymain('sub1', 'sub2', 'sub3')
+if __name__ == '__main__':
+    mymain('sub1', 'sub2', 'sub3')
@@ -16,14 +16,37 @@ test the ExpandCombinations recursive combination iteration class
 # test_expand.py -b
 
 import unittest
+import unittest.mock
+import asyncio
 import copy
-from collections import OrderedDict as odict
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict as odict
+from collections.abc import Mapping
 # https://docs.python.org/3/library/collections.html#collections.OrderedDict
 # pylint: disable=unused-import
 import env  # append parent directory to import path
 # pylint: enable=unused-import
 # needs both 'env' above, and __init__.py to exist, to import and keep pylint happy
-from expand_combinations import ExpandCombinations
+from expand_combinations import ExpandCombinations, ExpansionPlan, LayeredCombination, PlanCache
+from expand_combinations import MISSING, hashable_form, parallel_map, unique_key
+from expand_combinations import AsyncCombinations, Constraint, ExpansionStats
+from expand_combinations import exclude, expansion_diff, include, main
+from benchmarks import compare_results, measure, synthetic_spec
+try:
+    import numpy
+except ImportError:  # array batches are only tested when numpy is installed
+    numpy = None
+try:
+    import yaml
+except ImportError:  # YAML specifications are only tested when PyYAML is installed
+    yaml = None
 # pylint: disable=protected-access
 
 
@@ -65,6 +88,73 @@ def multiple_key_permutations(allref: list) -> list:
             iter_idx -= 1  # yo-yo up, backtracking to higher (previous) element
 
 
+def sample_specs() -> dict:
+    '''fresh copies of (most of) the samples.py input data, keyed by sample name'''
+    cheeses = ['cheddar', 'goat', 'feta', 'parmesan']
+    vegetables = ['avocado', 'mushrooms', 'onions', 'spinach']
+    meats = ['bacon', 'beef', 'pepperoni']
+    seafood = ['shrimp', 'anchovies', 'prawns']
+    toppings = [cheeses, vegetables, meats, seafood, ]
+    return {
+        's1': {'key1': 'constant value', 'key2': ['option 1', 'option 2', ], },
+        's2': {'key1': 'constant value', 'key2': ['option 1', 'option 2', ],
+               'key3': ['option 3', 'option 4', ], },
+        's3': {'key1': 'default value', 'key2': [
+            'option 1',
+            {'key3': 'fixed value', 'key4': ['option 2', 'option 3'], },
+            {'key1': 'override', 'key2': 'keep key'}, ], },
+        'list1': ['first', 'second', 'third', ],
+        'list2': ['dup', 'dup', 'third', ],
+        'l1': ['a', ['b', 'c'], 'd', ],
+        'l2': ['a', {'k1': [1, 2, ], 'k2': 'c'}, {'k3': ['a', 'b', ], 'k4': 5}, ],
+        'dup1': {'cmn': 'always', 'hasdup': ['dup', 'dup', 'other'], },
+        'equiv4': {'key': [{'key': [{'key': 'value', }, ], }, ], },
+        'equiv7': {'other1': [{'other2': [{'key': 'value', }, ], }, ], },
+        'test0': 'simple string',
+        'test1': {'key': 'value', 'dummy': [], },
+        'sub2': {
+            'footprint': '',
+            'mounting': 'THT',
+            'package': [
+                {'package': 'TO92', 'footprint': ['SIL', 'triangle', ], },
+                {'package': 'SOT23', 'mounting': 'SMD', },
+                'TO220', ],
+            'label': ['pin', '', ],
+            'type': ['NPN', 'PNP', ],
+            'pinout': ['BCE', 'BEC', 'CBE', 'CEB', 'EBC', 'ECB', ],
+        },
+        'sub3': {
+            'footprint': '',
+            'mounting': 'THT',
+            'package': [
+                'TO220',
+                {'package': 'TO92', 'footprint': ['SIL', 'triangle', ], },
+                {'package': 'SOT23', 'mounting': 'SMD', }, ],
+            'label': ['pin', '', ],
+            'type': ['NPN', 'PNP', ],
+            'pinout': ['BCE', 'BEC', 'CBE', 'CEB', 'EBC', 'ECB', ],
+        },
+        'meals': {
+            'appetizer': ['calamari', 'potatoe skins', 'cheesy nachos', 'escargot', ],
+            'entrée': [
+                'chicken',
+                {'entrée': ['white fish', 'rainbow trout'], 'wine': 'white'},
+                {'entrée': 'steak', 'wine': 'red'}, ],
+            'desert': ['pie', 'tiramisu', 'ice cream', 'apple crisp', ],
+        },
+        'pizza': [
+            {'first': toppings, },
+            {'first': toppings, 'second': toppings, },
+            {'first': toppings, 'second': toppings, 'third': toppings, },
+        ],
+        # edge cases: empty layers, nested dictionaries, and lists that expand to nothing
+        'empty_layer': {'first': [], 'second': [1, 2, ], 'third': {}, },
+        'dict_in_dict': {'outer': {'inner': [1, 2, ], 'fixed': 'x'}, 'last': [5, 6, ], },
+        'no_output': {'key1': [1, 2, ], 'key2': [[]], },
+        'list_mix': [1, [], {'key1': [1, 2, ], }, [[]], 2, ],
+    }
+
+
 class TestAllowedNestable(unittest.TestCase):
     '''Directly test nestable_object static method'''
     @classmethod
@@ -784,6 +874,1397 @@ class TestIteratorCreation(unittest.TestCase):
                                 self._unordered_list_compare(self.expected_out[exp_case], captured)
             # IDEA check that change to captured elements do not affect other elements??
 
+class TestExpansionPlan(unittest.TestCase):
+    '''test sharing a single pre-analysed plan between multiple iterators'''
+    @classmethod
+    def setUpClass(cls):
+        cls.spec = {
+            'footprint': '',
+            'mounting': 'THT',
+            'package': [
+                {'package': 'TO92', 'footprint': ['SIL', 'triangle', ], },
+                {'package': 'SOT23', 'mounting': 'SMD', },
+                'TO220', ],
+            'label': ['pin', '', ],
+            'type': ['NPN', 'PNP', ],
+            'empty': [],
+        }
+        cls.expected = list(ExpandCombinations(copy.deepcopy(cls.spec)))
+
+    # @unittest.skip('why?')
+    def test_plan_is_reiterable(self):
+        '''each pass over the plan should generate the full expansion again'''
+        plan = ExpansionPlan(self.spec)
+        self.assertEqual(16, len(self.expected))
+        self.assertEqual(self.expected, list(plan))
+        self.assertEqual(self.expected, list(plan))
+        self.assertEqual(['a', 'b'], list(ExpansionPlan(['a', ['b']])))
+
+    # @unittest.skip('why?')
+    def test_independent_iterators(self):
+        '''interleaved iterators over the same plan should not interfere'''
+        plan = ExpansionPlan(self.spec)
+        first = ExpandCombinations(plan)
+        second = ExpandCombinations(plan)
+        self.assertIs(plan, first.plan())
+        captured = ([], [], )
+        for dummy_idx in range(len(self.expected)):
+            captured[0].append(next(first))
+            captured[1].append(next(second))
+        self.assertEqual(self.expected, captured[0])
+        self.assertEqual(self.expected, captured[1])
+        self.assertRaises(StopIteration, next, first)
+
+    # @unittest.skip('why?')
+    def test_reset(self):
+        '''reset should restart the expansion from any position'''
+        instance = ExpandCombinations(self.spec)
+        for stop_at in (0, 1, 5, len(self.expected)):
+            with self.subTest(stop_at=stop_at):
+                instance.reset()
+                for dummy_idx in range(stop_at):
+                    next(instance)
+                instance.reset()
+                self.assertEqual(self.expected, list(instance))
+                self.assertRaises(StopIteration, next, instance)
+
+    # @unittest.skip('why?')
+    def test_no_analysis_while_iterating(self):
+        '''restarting nested layers should not build any new plans'''
+        plan = ExpansionPlan(self.spec)
+        with unittest.mock.patch.object(
+                ExpansionPlan, '__init__', side_effect=AssertionError('plan rebuilt')):
+            self.assertEqual(self.expected, list(plan))
+
+    # @unittest.skip('why?')
+    def test_threads(self):
+        '''iterators in different threads can share a plan'''
+        plan = ExpansionPlan(self.spec)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda dummy: list(ExpandCombinations(plan)), range(8)))
+        for captured in results:
+            self.assertEqual(self.expected, captured)
+
+
+class TestCount(unittest.TestCase):
+    '''test calculating the number of combinations without generating them'''
+
+    # @unittest.skip('why?')
+    def test_count_matches_expansion(self):
+        '''the calculated count should match the number of generated combinations'''
+        for name, spec in sample_specs().items():
+            with self.subTest(case=name):
+                plan = ExpansionPlan(spec)
+                self.assertEqual(len(list(ExpandCombinations(spec))), plan.count())
+                self.assertEqual(plan.count(), len(plan))
+                self.assertEqual(plan.count(), ExpandCombinations(plan).count())
+
+    # @unittest.skip('why?')
+    def test_count_rules(self):
+        '''list sizes add, dictionary layers multiply, raw and empty list are a single entry'''
+        samples = sample_specs()
+        self.assertEqual(2954, ExpansionPlan(samples['pizza']).count())
+        self.assertEqual(64, ExpansionPlan(samples['meals']).count())
+        self.assertEqual(2, ExpansionPlan(samples['empty_layer']).count())
+        self.assertEqual(0, ExpansionPlan(samples['no_output']).count())
+        self.assertEqual(1, ExpansionPlan(samples['test0']).count())
+        self.assertEqual(0, ExpansionPlan([]).count())
+        self.assertEqual(1, ExpansionPlan({}).count())
+
+    # @unittest.skip('why?')
+    def test_count_is_not_enumerated(self):
+        '''huge expansions should be counted from the structure alone'''
+        spec = {'key{}'.format(idx): list(range(10)) for idx in range(30)}
+        self.assertEqual(10 ** 30, ExpansionPlan(spec).count())
+        self.assertRaises(OverflowError, len, ExpansionPlan(spec))
+
+
+class TestRandomAccess(unittest.TestCase):
+    '''test building individual combinations directly from their index'''
+
+    # @unittest.skip('why?')
+    def test_index_matches_iteration(self):
+        '''every index should give the same combination as iteration, in the same order'''
+        for name, spec in sample_specs().items():
+            with self.subTest(case=name):
+                plan = ExpansionPlan(spec)
+                expected = list(ExpandCombinations(spec))
+                for idx, combination in enumerate(expected):
+                    self.assertEqual(combination, plan[idx])
+                    self.assertEqual(combination, plan[idx - len(expected)])
+                    if isinstance(combination, dict):
+                        self.assertEqual(list(combination), list(plan[idx]), 'key order')
+                self.assertEqual(expected, plan[:])
+
+    # @unittest.skip('why?')
+    def test_slices(self):
+        '''slices should match the same slice of the full expansion'''
+        spec = sample_specs()['sub2']
+        expected = list(ExpandCombinations(spec))
+        instance = ExpandCombinations(spec)
+        for case in (slice(5, 20), slice(None, None, 7), slice(-3, None), slice(50, 10, -4)):
+            with self.subTest(slice=case):
+                self.assertEqual(expected[case], instance[case])
+
+    # @unittest.skip('why?')
+    def test_out_of_range(self):
+        '''invalid indices should be rejected'''
+        plan = ExpansionPlan(sample_specs()['meals'])
+        for idx in (64, -65, 1000):
+            with self.subTest(idx=idx):
+                self.assertRaises(IndexError, plan.__getitem__, idx)
+        self.assertRaises(TypeError, plan.__getitem__, 'first')
+        self.assertRaises(IndexError, ExpansionPlan([]).__getitem__, 0)
+
+    # @unittest.skip('why?')
+    def test_fresh_results(self):
+        '''each access should build a new combination, not share one'''
+        plan = ExpansionPlan(sample_specs()['l2'])
+        first = plan[1]
+        first['k1'] = 'changed'
+        self.assertEqual({'k1': 1, 'k2': 'c'}, plan[1])
+
+    # @unittest.skip('why?')
+    def test_huge_index(self):
+        '''combinations deep into a huge expansion should be built directly'''
+        spec = {'key{}'.format(idx): list(range(10)) for idx in range(30)}
+        combination = ExpansionPlan(spec)[123456789 * 10 ** 21]
+        expected = dict(('key{}'.format(idx), int(digit))
+                        for idx, digit in enumerate('{:030d}'.format(123456789 * 10 ** 21)))
+        self.assertEqual(expected, combination)
+
+
+class TestInverseLookup(unittest.TestCase):
+    '''test finding where a combination is generated, without generating the expansion'''
+
+    # @unittest.skip('why?')
+    def test_indices_match_iteration(self):
+        '''every generated combination should be found at every index it is generated'''
+        for name, spec in sample_specs().items():
+            with self.subTest(case=name):
+                plan = ExpansionPlan(spec)
+                expected = list(ExpandCombinations(spec))
+                for idx, combination in enumerate(expected):
+                    self.assertIn(combination, plan)
+                    self.assertEqual(expected.index(combination), plan.index_of(combination))
+                    self.assertIn(idx, plan.indices_of(combination))
+
+    # @unittest.skip('why?')
+    def test_duplicates(self):
+        '''combinations generated from more than one path should report every index'''
+        samples = sample_specs()
+        self.assertEqual([0, 1], ExpansionPlan(samples['list2']).indices_of('dup'))
+        plan = ExpansionPlan(samples['dup1'])
+        self.assertEqual([0, 1], plan.indices_of({'cmn': 'always', 'hasdup': 'dup'}))
+        self.assertEqual([2], plan.indices_of({'cmn': 'always', 'hasdup': 'other'}))
+        plan = ExpansionPlan({'key': ['value', {'key': 'value'}, [{'key': ['value']}]]})
+        self.assertEqual([0, 1, 2], plan.indices_of({'key': 'value'}))
+
+    # @unittest.skip('why?')
+    def test_overrides(self):
+        '''cascaded (overridden) values should only match the final value'''
+        plan = ExpansionPlan(sample_specs()['sub2'])
+        smd = {'footprint': '', 'mounting': 'SMD', 'package': 'SOT23',
+               'label': 'pin', 'type': 'PNP', 'pinout': 'CBE'}
+        self.assertEqual(list(plan).index(smd), plan.index_of(smd))
+        smd['mounting'] = 'THT'
+        self.assertNotIn(smd, plan)
+        self.assertEqual([], plan.indices_of(smd))
+        plan = ExpansionPlan({'key': list(range(5)), 'over': [{'key': 'fixed'}]})
+        self.assertEqual([0, 1, 2, 3, 4], plan.indices_of({'key': 'fixed'}))
+        self.assertNotIn({'key': 3}, plan)
+
+    # @unittest.skip('why?')
+    def test_not_generated(self):
+        '''missing, extra, or changed keys should not be found'''
+        instance = ExpandCombinations(sample_specs()['meals'])
+        meal = {'appetizer': 'escargot', 'entrée': 'steak', 'wine': 'red', 'desert': 'pie'}
+        self.assertIn(meal, instance)
+        self.assertEqual(next(instance), instance[0], 'lookup should not consume')
+        for case in ({'appetizer': 'escargot', 'entrée': 'steak', 'desert': 'pie'},
+                     dict(meal, extra='key'), dict(meal, wine='white'), 'escargot', None):
+            with self.subTest(case=case):
+                self.assertNotIn(case, instance)
+                self.assertRaises(ValueError, instance.index_of, case)
+
+    # @unittest.skip('why?')
+    def test_huge_lookup(self):
+        '''combinations deep into a huge expansion should be found from the structure'''
+        spec = {'key{}'.format(idx): list(range(10)) for idx in range(30)}
+        idx = 987654321 * 10 ** 20
+        plan = ExpansionPlan(spec)
+        self.assertEqual([idx], plan.indices_of(plan[idx]))
+
+
+class TestProjection(unittest.TestCase):
+    '''test listing the distinct values of selected keys from the structure'''
+
+    # @unittest.skip('why?')
+    def test_matches_expansion(self):
+        '''projections should be the distinct values found in the full expansion'''
+        for name, spec in sample_specs().items():
+            plan = ExpansionPlan(spec)
+            if plan.raw_results():
+                self.assertRaises(ValueError, plan.project, ['key'])
+                continue
+            for size in range(3):
+                for keys in itertools.combinations(plan.result_keys(), size):
+                    with self.subTest(spec=name, keys=keys):
+                        expected = odict()
+                        for cmb in plan:
+                            projected = {key: cmb[key] for key in keys if key in cmb}
+                            expected.setdefault(hashable_form(projected), projected)
+                        self.assertEqual(list(expected.values()), plan.project(keys))
+
+    # @unittest.skip('why?')
+    def test_cascade(self):
+        '''nested dictionaries should override earlier values of the projected keys'''
+        self.assertEqual([{'package': 'TO220', 'mounting': 'THT'},
+                          {'package': 'TO92', 'mounting': 'THT'},
+                          {'package': 'SOT23', 'mounting': 'SMD'}],
+                         ExpandCombinations(sample_specs()['sub3']).project(
+                             ['package', 'mounting']))
+        self.assertEqual([{'key2': 'option 1'}, {}, {'key2': 'keep key'}],
+                         ExpansionPlan(sample_specs()['s3']).project(['key2']))
+
+    # @unittest.skip('why?')
+    def test_skips_subtrees(self):
+        '''layers that can not change the projection should not be looked at'''
+        spec = {'small': ['a', 'b'], 'other': ['x', 'y']}
+        spec.update({'big{}'.format(idx): list(range(1000)) for idx in range(4)})
+        plan = ExpansionPlan(spec)
+        self.assertEqual(4 * 10 ** 12, plan.count())
+        self.assertEqual([{'small': 'a', 'other': 'x'}, {'small': 'a', 'other': 'y'},
+                          {'small': 'b', 'other': 'x'}, {'small': 'b', 'other': 'y'}],
+                         plan.project(['small', 'other']))
+        self.assertEqual([], ExpansionPlan({'small': ['a'], 'none': [[]]}).project(['small']))
+
+    # @unittest.skip('why?')
+    def test_unavailable(self):
+        '''slots and constraints change which combinations exist'''
+        pizza = ExpansionPlan(sample_specs()['pizza'], [['first', 'second', 'third']])
+        self.assertRaises(ValueError, pizza.project, ['first'])
+        meals = ExpandCombinations(sample_specs()['meals'],
+                                   constraints=[exclude({'wine': 'red'})])
+        self.assertRaises(ValueError, meals.project, ['wine'])
+
+
+class TestHistogram(unittest.TestCase):
+    '''test counting the values of keys from the structure'''
+
+    # @unittest.skip('why?')
+    def test_matches_expansion(self):
+        '''calculated counts should match counting the full expansion'''
+        for name, spec in sample_specs().items():
+            plan = ExpansionPlan(spec)
+            if plan.raw_results():
+                self.assertRaises(ValueError, plan.histogram, 'key')
+                continue
+            histograms = plan.aggregate()
+            self.assertEqual(list(plan.result_keys()), list(histograms))
+            for key in plan.result_keys() + ('not a key', ):
+                with self.subTest(spec=name, key=key):
+                    expected = Counter(hashable_form(cmb[key]) if key in cmb else MISSING
+                                       for cmb in plan)
+                    self.assertEqual(expected, plan.histogram(key))
+                    if key in histograms:
+                        self.assertEqual(expected, histograms[key])
+
+    # @unittest.skip('why?')
+    def test_overrides(self):
+        '''nested dictionaries replace the value set before them'''
+        for name in ('sub2', 'sub3'):
+            with self.subTest(spec=name):
+                walker = ExpandCombinations(sample_specs()[name])
+                # TO220, TO92 (2 footprints), SOT23: a quarter are SMD
+                self.assertEqual(Counter({'THT': 3 * walker.count() // 4,
+                                          'SMD': walker.count() // 4}),
+                                 walker.histogram('mounting'))
+        self.assertEqual(Counter({'white': 32, 'red': 16, MISSING: 16}),
+                         ExpansionPlan(sample_specs()['meals']).histogram('wine'))
+        big = {'size': ['S', 'M', {'size': 'L', 'extra': [1, 2, 3]}]}
+        big.update({'k{}'.format(idx): list(range(100)) for idx in range(6)})
+        self.assertEqual(Counter({'S': 10 ** 12, 'M': 10 ** 12, 'L': 3 * 10 ** 12}),
+                         ExpansionPlan(big).histogram('size'))
+
+    # @unittest.skip('why?')
+    def test_unavailable(self):
+        '''slots and constraints change which combinations exist'''
+        pizza = ExpansionPlan(sample_specs()['pizza'], [['first', 'second', 'third']])
+        self.assertRaises(ValueError, pizza.histogram, 'first')
+        meals = ExpandCombinations(sample_specs()['meals'],
+                                   constraints=[exclude({'wine': 'red'})])
+        self.assertRaises(ValueError, meals.histogram, 'wine')
+        self.assertRaises(ValueError, meals.aggregate)
+
+
+class TestGrayCode(unittest.TestCase):
+    '''test the minimal change order, and the stream of changes'''
+
+    @staticmethod
+    def changed(first: dict, second: dict) -> int:
+        '''returns the number of keys with a different value (or missing) in second'''
+        return sum(1 for key in set(first) | set(second)
+                   if first.get(key, MISSING) != second.get(key, MISSING))
+
+    # @unittest.skip('why?')
+    def test_same_combinations(self):
+        '''the minimal change order should hold every combination, with fewer changes'''
+        for name, spec in sample_specs().items():
+            with self.subTest(spec=name):
+                plan = ExpansionPlan(spec)
+                expected = list(plan)
+                ordered = list(ExpandCombinations(spec).gray_code())
+                self.assertEqual(Counter(map(hashable_form, expected)),
+                                 Counter(map(hashable_form, ordered)))
+                if plan.raw_results():
+                    continue
+                self.assertLessEqual(
+                    sum(map(self.changed, ordered, ordered[1:])),
+                    sum(map(self.changed, expected, expected[1:])))
+
+    # @unittest.skip('why?')
+    def test_single_change(self):
+        '''consecutive combinations of simple lists should differ in exactly one key'''
+        for spec in (sample_specs()['s2'], synthetic_spec(depth=1, width=4, list_length=3),
+                     {'a': [1, 2], 'b': [], 'c': ['x', 'y', 'z'], 'd': 'fixed'}):
+            with self.subTest(spec=spec):
+                ordered = list(ExpansionPlan(spec).gray_code())
+                self.assertEqual(ExpansionPlan(spec).count(), len(ordered))
+                self.assertEqual([1] * (len(ordered) - 1),
+                                 list(map(self.changed, ordered, ordered[1:])))
+
+    # @unittest.skip('why?')
+    def test_deltas(self):
+        '''applying the changes in turn should rebuild every combination'''
+        for name, spec in sample_specs().items():
+            plan = ExpansionPlan(spec)
+            if plan.raw_results():
+                self.assertRaises(ValueError, next, plan.deltas())
+                continue
+            for gray in (True, False):
+                with self.subTest(spec=name, gray=gray):
+                    rebuilt = []
+                    current = {}
+                    for change in plan.deltas(gray):
+                        for key, value in change.items():
+                            if value is MISSING:
+                                del current[key]
+                            else:
+                                current[key] = value
+                        rebuilt.append(dict(current))
+                    self.assertEqual(list(plan.gray_code()) if gray else list(plan), rebuilt)
+        changes = list(ExpansionPlan(sample_specs()['s3']).deltas(gray=False))
+        self.assertEqual({'key2': MISSING, 'key3': 'fixed value', 'key4': 'option 2'},
+                         changes[1])
+
+    # @unittest.skip('why?')
+    def test_unavailable(self):
+        '''slots and constraints change which combinations exist'''
+        pizza = ExpansionPlan(sample_specs()['pizza'], [['first', 'second', 'third']])
+        self.assertRaises(ValueError, next, pizza.gray_code())
+        meals = ExpandCombinations(sample_specs()['meals'],
+                                   constraints=[exclude({'wine': 'red'})])
+        self.assertRaises(ValueError, meals.gray_code)
+        self.assertRaises(ValueError, meals.deltas)
+
+
+class TestExpansionDiff(unittest.TestCase):
+    '''test finding the combinations added (and removed) by a specification change'''
+
+    def check_diff(self, old: object, new: object):
+        '''the changes should match comparing both full expansions'''
+        old_seen = set(map(hashable_form, ExpansionPlan(old)))
+        new_seen = set(map(hashable_form, ExpansionPlan(new)))
+        expected = [('+', cmb) for cmb in ExpansionPlan(new)
+                    if hashable_form(cmb) not in old_seen]
+        expected += [('-', cmb) for cmb in ExpansionPlan(old)
+                     if hashable_form(cmb) not in new_seen]
+        self.assertEqual(expected, list(expansion_diff(old, new, removed=True)))
+        self.assertEqual([cmb for change, cmb in expected if change == '+'],
+                         list(ExpansionPlan(new).added_since(old)))
+
+    # @unittest.skip('why?')
+    def test_changes(self):
+        '''added options, entries and keys should give exactly the new combinations'''
+        for name in ('s2', 's3', 'l2', 'sub2', 'sub3', 'meals', 'dup1', 'list2'):
+            spec = sample_specs()[name]
+            edits = {
+                'same': lambda edit: None,
+                'append': lambda edit: next(value for value in edit.values()
+                                            if isinstance(value, list)).append('extra'),
+                'nested': lambda edit: next(value for value in edit.values()
+                                            if isinstance(value, list)).insert(
+                                                0, {'new key': ['x', 'y']}),
+                'static': lambda edit: edit.update(added='static'),
+            } if isinstance(spec, dict) else {
+                'append': lambda edit: edit.append('extra'),
+                'replace': lambda edit: edit.__setitem__(0, {'k1': [7]}),
+            }
+            for edit_name, edit in edits.items():
+                with self.subTest(spec=name, edit=edit_name):
+                    new = copy.deepcopy(spec)
+                    edit(new)
+                    self.check_diff(spec, new)
+                    self.check_diff(new, spec)  # and the other way: removed options
+
+    # @unittest.skip('why?')
+    def test_structural(self):
+        '''only the changed part of the expansion should be looked at'''
+        spec = {'fixed': 'x', 'big': list(range(100)), 'more': list(range(100)),
+                'small': ['a', 'b']}
+        new = dict(spec, small=['a', 'b', 'c'])
+        checked = []
+        original = ExpansionPlan.__contains__
+
+        def spy(plan, combination):
+            checked.append(combination)
+            return original(plan, combination)
+        with unittest.mock.patch.object(ExpansionPlan, '__contains__', spy):
+            added = list(ExpansionPlan(new).added_since(spec))
+        self.assertEqual(10 ** 4, len(added))
+        self.assertTrue(all(cmb['small'] == 'c' for cmb in added))
+        # the new small value, then each combination using it: not the 20000 others
+        self.assertEqual(1 + 10 ** 4, len(checked))
+        self.assertEqual([], list(expansion_diff(spec, copy.deepcopy(spec), removed=True)))
+
+
+class TestIndexTuples(unittest.TestCase):
+    '''test encoding combinations as tuples of choice indexes, and decoding them'''
+
+    # @unittest.skip('why?')
+    def test_round_trip(self):
+        '''every tuple should decode to the combination iteration generates'''
+        plans = {name: ExpansionPlan(spec) for name, spec in sample_specs().items()}
+        plans['pizza slots'] = ExpansionPlan(sample_specs()['pizza'],
+                                             [['first', 'second', 'third']])
+        for name, plan in plans.items():
+            with self.subTest(spec=name):
+                expected = list(ExpandCombinations(plan))
+                codes = list(plan.encodings())
+                self.assertEqual(expected, [plan.decode(cmb) for cmb in codes])
+                self.assertEqual(codes, [plan.encoding(idx)
+                                         for idx in range(len(expected))])
+                self.assertEqual(codes, sorted(codes))
+                self.assertEqual(len(codes), len(set(codes)))
+                self.assertTrue(all(isinstance(choice, int)
+                                    for cmb in codes for choice in cmb))
+
+    # @unittest.skip('why?')
+    def test_choices(self):
+        '''one choice per decision made, in the order they are made'''
+        plan = ExpansionPlan({'k1': 'fixed', 'k2': ['a', {'k3': [1, 2]}], 'k4': [5, 6]})
+        self.assertEqual([(0, 0), (0, 1), (1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1)],
+                         list(plan.encodings()))
+        self.assertEqual({'k1': 'fixed', 'k3': 2, 'k4': 5}, plan.decode((1, 1, 0)))
+        self.assertEqual((1, 1, 0), plan.encoding(-2))
+        self.assertEqual([()], list(ExpansionPlan('raw').encodings()))
+        for bad in ((0, ), (0, 0, 0), (2, 0), (1, 0, -1)):
+            with self.subTest(codes=bad):
+                with self.assertRaises(ValueError):
+                    plan.decode(bad)
+        with self.assertRaises(IndexError):
+            plan.encoding(6)
+        with self.assertRaises(ValueError):
+            ExpandCombinations({'k1': [1, 2]}, constraints=[exclude({'k1': 1})]).encodings()
+
+
+class TestShards(unittest.TestCase):
+    '''test generating only part (a shard, or index range) of an expansion'''
+
+    # @unittest.skip('why?')
+    def test_shards_cover_expansion(self):
+        '''all shards together should generate every combination once, in order'''
+        for name, spec in sample_specs().items():
+            plan = ExpansionPlan(spec)
+            expected = list(plan)
+            for shard_count in (1, 2, 3, 7):
+                with self.subTest(case=name, shards=shard_count):
+                    captured = []
+                    for shard_idx in range(shard_count):
+                        captured.extend(ExpandCombinations(plan, shard=(shard_idx, shard_count)))
+                    self.assertEqual(expected, captured)
+
+    # @unittest.skip('why?')
+    def test_index_ranges(self):
+        '''start and stop should work the same as slicing the full expansion'''
+        spec = sample_specs()['sub2']
+        expected = list(ExpandCombinations(spec))
+        for start, stop in ((0, 10), (7, 8), (30, None), (None, 5), (-4, None), (50, 20),
+                            (0, 1000)):
+            with self.subTest(start=start, stop=stop):
+                instance = ExpandCombinations(spec, start=start, stop=stop)
+                self.assertEqual(expected[start:stop], list(instance))
+                instance.reset()
+                self.assertEqual(expected[start:stop], list(instance), 'after reset')
+        flat = ExpandCombinations(['a', 'b', 'c', 'd'], start=1, stop=3)
+        self.assertEqual(['b', 'c'], list(flat))
+
+    # @unittest.skip('why?')
+    def test_starts_directly(self):
+        '''a shard deep into a huge expansion should start without skipping through'''
+        spec = {'key{}'.format(idx): list(range(10)) for idx in range(30)}
+        plan = ExpansionPlan(spec)
+        instance = ExpandCombinations(plan, shard=(5, 7))
+        start = 5 * plan.count() // 7
+        self.assertEqual([plan[start], plan[start + 1], plan[start + 2]],
+                         [next(instance), next(instance), next(instance)])
+
+    # @unittest.skip('why?')
+    def test_invalid_shard(self):
+        '''shard has to be (index, count) with 0 <= index < count'''
+        spec = sample_specs()['s2']
+        for shard in ((2, 2), (-1, 3), (0, 0)):
+            with self.subTest(shard=shard):
+                self.assertRaises(ValueError, ExpandCombinations, spec, shard=shard)
+        self.assertRaises(ValueError, ExpandCombinations, spec, shard=(0, 2), start=1)
+
+
+def combination_summary(combination: dict) -> tuple:
+    '''(picklable) function for parallel_map to apply to each combination'''
+    return tuple(sorted(combination.items()))
+
+
+class TestParallelMap(unittest.TestCase):
+    '''test applying a function to every combination with a pool of worker processes'''
+
+    # @unittest.skip('why?')
+    def test_ordered(self):
+        '''ordered results should match applying the function while iterating'''
+        spec = sample_specs()['sub2']
+        expected = [combination_summary(cmb) for cmb in ExpandCombinations(spec)]
+        for chunksize in (1, 7, 1000):
+            with self.subTest(chunksize=chunksize):
+                self.assertEqual(expected, list(parallel_map(
+                    combination_summary, spec, workers=2, chunksize=chunksize)))
+
+    # @unittest.skip('why?')
+    def test_unordered(self):
+        '''unordered results should have every result, as chunks finish'''
+        plan = ExpansionPlan(sample_specs()['meals'])
+        expected = [combination_summary(cmb) for cmb in plan]
+        captured = list(parallel_map(combination_summary, plan, workers=3, chunksize=5,
+                                     ordered=False, max_pending=2))
+        self.assertEqual(sorted(expected), sorted(captured))
+
+    # @unittest.skip('why?')
+    def test_stop_early(self):
+        '''a caller that stops early should not need the full expansion'''
+        spec = {'key{}'.format(idx): list(range(10)) for idx in range(30)}
+        results = parallel_map(combination_summary, spec, workers=2, chunksize=10)
+        self.assertEqual(combination_summary(ExpansionPlan(spec)[12]),
+                         next(itertools.islice(results, 12, None)))
+        results.close()
+        self.assertEqual([], list(parallel_map(combination_summary, {'key': [[]]})))
+        self.assertRaises(ValueError, list, parallel_map(len, spec, chunksize=0))
+
+
+class TestRandomSampling(unittest.TestCase):
+    '''test picking random combinations without generating the expansion'''
+
+    # @unittest.skip('why?')
+    def test_sample(self):
+        '''samples should be different combinations from the expansion'''
+        plan = ExpansionPlan(sample_specs()['pizza'])
+        expansion = list(plan)
+        picked = plan.sample(50, seed=42)
+        self.assertEqual(50, len(picked))
+        indices = [expansion.index(cmb) for cmb in picked]
+        self.assertEqual(50, len(set(indices)), 'should not repeat any index')
+        self.assertEqual(picked, plan.sample(50, seed=42), 'same seed, same sample')
+        self.assertNotEqual(picked, plan.sample(50, seed=43))
+        self.assertEqual([], plan.sample(0))
+        self.assertEqual(sorted(map(str, expansion)), sorted(map(str, plan.sample(len(plan)))))
+        self.assertRaises(ValueError, plan.sample, len(plan) + 1)
+        self.assertEqual(picked[:5], ExpandCombinations(plan).sample(50, seed=42)[:5])
+
+    # @unittest.skip('why?')
+    def test_huge_sample(self):
+        '''sampling a huge expansion should only build the picked combinations'''
+        spec = {'key{}'.format(idx): list(range(10)) for idx in range(30)}
+        plan = ExpansionPlan(spec)
+        for combination in plan.sample(100, seed='huge'):
+            self.assertIn(combination, plan)
+
+    # @unittest.skip('why?')
+    def test_random_stream(self):
+        '''stream should endlessly pick (repeatable) combinations uniformly'''
+        plan = ExpansionPlan(sample_specs()['s2'])
+        stream = plan.random_stream(seed=7)
+        picked = [next(stream) for dummy_idx in range(4000)]
+        again = list(itertools.islice(ExpandCombinations(plan).random_stream(seed=7), 4000))
+        self.assertEqual(picked, again)
+        for combination in plan:
+            with self.subTest(combination=combination):
+                self.assertLess(abs(picked.count(combination) - 1000), 150)
+        self.assertEqual([], list(ExpansionPlan([]).random_stream()))
+
+
+class TestUnique(unittest.TestCase):
+    '''test removing repeated combinations while iterating'''
+
+    # @unittest.skip('why?')
+    def test_whole_combination(self):
+        '''unique=True should drop exact repeats, keeping the first in order'''
+        samples = sample_specs()
+        self.assertEqual(['dup', 'third'], list(ExpandCombinations(samples['list2'], unique=True)))
+        self.assertEqual([{'cmn': 'always', 'hasdup': 'dup'}, {'cmn': 'always', 'hasdup': 'other'}],
+                         list(ExpandCombinations(samples['dup1'], unique=True)))
+        expected = list(ExpandCombinations(samples['sub2']))
+        self.assertEqual(expected, list(ExpandCombinations(samples['sub2'], unique=True)))
+
+    # @unittest.skip('why?')
+    def test_selected_keys(self):
+        '''only the selected keys should be compared'''
+        meals = sample_specs()['meals']
+        self.assertEqual([{'appetizer': 'calamari', 'entrée': 'chicken', 'desert': 'pie'},
+                          {'appetizer': 'calamari', 'entrée': 'white fish', 'wine': 'white',
+                           'desert': 'pie'},
+                          {'appetizer': 'calamari', 'entrée': 'steak', 'wine': 'red',
+                           'desert': 'pie'}],
+                         list(ExpandCombinations(meals, unique=['wine'])))
+        self.assertEqual(4, len(list(ExpandCombinations(meals, unique=('entrée', 'wine')))))
+
+    # @unittest.skip('why?')
+    def test_unordered_values(self):
+        '''unordered should compare the multiset of values, as for the readme pizza recipe'''
+        pizza_keys = ['first', 'second', 'third']
+        dedup = []
+        for cmb in ExpandCombinations(sample_specs()['pizza']):
+            cmb_toppings = sorted(cmb[pkey] for pkey in pizza_keys if pkey in cmb)
+            if cmb_toppings not in dedup:
+                dedup.append(cmb_toppings)
+        instance = ExpandCombinations(sample_specs()['pizza'], unique=pizza_keys, unordered=True)
+        captured = [sorted(cmb.values()) for cmb in instance]
+        self.assertEqual(679, len(captured))
+        self.assertEqual(dedup, captured)
+        instance.reset()
+        self.assertEqual(679, len(list(instance)), 'reset should forget seen combinations')
+
+    # @unittest.skip('why?')
+    def test_unhashable_values(self):
+        '''values that can not be hashed directly should still be compared'''
+        spec = {'key': [('tuple', ['with', 'list']), ('tuple', ['with', 'list']),
+                        ('tuple', ['other']), ('tuple', ('with', 'list')), ],
+                'set': [{'first': ['a', 'b']}], }
+        self.assertEqual(['with', 'list'], spec['key'][0][1])
+        captured = list(ExpandCombinations(spec, unique=True))
+        self.assertEqual([('tuple', ['with', 'list']), ('tuple', ['other']),
+                          ('tuple', ('with', 'list'))], [cmb['key'] for cmb in captured[::2]])
+        self.assertEqual(6, len(captured))
+
+    # @unittest.skip('why?')
+    def test_custom_identity(self):
+        '''a callable should supply the identity used to find repeats'''
+        instance = ExpandCombinations(sample_specs()['sub2'], unique=lambda cmb: cmb['mounting'])
+        self.assertEqual(['THT', 'SMD'], [cmb['mounting'] for cmb in instance])
+
+    # @unittest.skip('why?')
+    def test_hashable_form(self):
+        '''equal values should have equal (hashable) forms, and different values not'''
+        self.assertEqual(hashable_form({'a': [1, {2}]}), hashable_form({'a': [1, {2}]}))
+        self.assertEqual(hashable_form((1, 'x')), (1, 'x'))
+        self.assertNotEqual(hashable_form([1, 2]), hashable_form((1, 2)))
+        self.assertNotEqual(hashable_form({'a': 1}), hashable_form([('a', 1)]))
+        self.assertEqual(hashable_form(unique_key()({'a': [1]})), unique_key()({'a': [1]}))
+
+
+class TestInterchangeable(unittest.TestCase):
+    '''test generating each multiset of interchangeable slot values only once'''
+
+    # @unittest.skip('why?')
+    def test_pizza(self):
+        '''interchangeable toppings should directly give the unique pizzas'''
+        pizza_keys = ['first', 'second', 'third']
+        spec = sample_specs()['pizza']
+        expected = list(ExpandCombinations(spec, unique=pizza_keys, unordered=True))
+        plan = ExpansionPlan(spec, interchangeable=[pizza_keys])
+        self.assertEqual(679, plan.count())
+        self.assertEqual(expected, list(plan))
+        self.assertEqual(expected, list(ExpandCombinations(spec, interchangeable=[pizza_keys])))
+        self.assertEqual([combination_summary(cmb) for cmb in expected],
+                         list(parallel_map(combination_summary, plan, workers=2, chunksize=100)))
+
+    # @unittest.skip('why?')
+    def test_separated_slots(self):
+        '''slots do not need to be next to each other, and other layers stay independent'''
+        spec = odict([('first', ['a', 'b', 'c']), ('size', ['S', 'L']),
+                      ('second', ['a', 'b', 'c']), ('fixed', 'x'), ('third', ['a', 'b', 'c'])])
+        plan = ExpansionPlan(spec, interchangeable=[('first', 'second', 'third')])
+        expected = [cmb for cmb in ExpandCombinations(spec)
+                    if cmb['first'] <= cmb['second'] <= cmb['third']]
+        self.assertEqual(20, plan.count())
+        self.assertEqual(expected, list(plan))
+
+    # @unittest.skip('why?')
+    def test_random_access(self):
+        '''index, lookup, shards and sampling should all follow the reduced expansion'''
+        pizza_keys = ['first', 'second', 'third']
+        plan = ExpansionPlan(sample_specs()['pizza'], interchangeable=[pizza_keys])
+        expected = list(plan)
+        for idx in range(0, len(expected), 17):
+            with self.subTest(idx=idx):
+                self.assertEqual(expected[idx], plan[idx])
+                self.assertEqual(idx, plan.index_of(expected[idx]))
+        swapped = {'first': 'shrimp', 'second': 'feta'}  # only generated as feta, shrimp
+        self.assertNotIn(swapped, plan)
+        self.assertIn({'first': 'feta', 'second': 'shrimp'}, plan)
+        captured = []
+        for shard_idx in range(4):
+            captured.extend(ExpandCombinations(plan, shard=(shard_idx, 4)))
+        self.assertEqual(expected, captured)
+        for cmb in plan.sample(20, seed=1):
+            self.assertIn(cmb, expected)
+
+    # @unittest.skip('why?')
+    def test_invalid_groups(self):
+        '''slots have to share the same options, and only be in one group'''
+        spec = {'first': ['a', 'b'], 'second': ['a', 'c'], 'third': ['a', 'b']}
+        self.assertRaises(ValueError, ExpansionPlan, spec, [('first', 'second')])
+        self.assertRaises(ValueError, ExpansionPlan, spec,
+                          [('first', 'third'), ('third', 'first')])
+        self.assertEqual(3, ExpansionPlan(spec, [('first', 'third')]).count() // 2)
+        self.assertRaises(ValueError, ExpandCombinations, ExpansionPlan(spec),
+                          interchangeable=[('first', 'third')])
+
+
+class TestLayered(unittest.TestCase):
+    '''test read-only layered views as the generated combinations'''
+
+    # @unittest.skip('why?')
+    def test_same_combinations(self):
+        '''layered views should hold the same values, in the same key order'''
+        for name, spec in sample_specs().items():
+            with self.subTest(spec=name):
+                expected = list(ExpandCombinations(spec))
+                layered = list(ExpandCombinations(spec, layered=True))
+                self.assertEqual(expected, layered)
+                for exp, cmb in zip(expected, layered):
+                    if isinstance(exp, dict):
+                        self.assertIsInstance(cmb, LayeredCombination)
+                        self.assertEqual(list(exp.items()), list(cmb.items()))
+                        self.assertEqual(exp, cmb.to_dict())
+                plan = ExpansionPlan(spec)
+                start = plan.count() // 2
+                self.assertEqual(expected[start:],
+                                 list(ExpandCombinations(plan, start=start, layered=True)))
+
+    # @unittest.skip('why?')
+    def test_shared_fragments(self):
+        '''views share fragments, so can not be changed, but to_dict copies can'''
+        spec = {'fixed': 'x', 'first': ['a', 'b'], 'second': [{'fixed': 'y'}, 'c']}
+        first, second = itertools.islice(ExpandCombinations(spec, layered=True), 2)
+        self.assertEqual({'fixed': 'y', 'first': 'a'}, first)
+        self.assertIs(first.maps[-1], second.maps[-1])
+        self.assertIs(first.maps[-2], second.maps[-2])
+        self.assertRaises(TypeError, first.__setitem__, 'first', 'z')
+        self.assertRaises(TypeError, first.__delitem__, 'first')
+        self.assertRaises(TypeError, first.pop, 'first')
+        self.assertRaises(TypeError, first.update, {'first': 'z'})
+        self.assertRaises(TypeError, first.clear)
+        changed = first.to_dict()
+        changed['first'] = 'z'
+        self.assertEqual({'fixed': 'x', 'first': 'a', 'second': 'c'}, second)
+        self.assertEqual('a', first['first'])
+
+
+class TestBatches(unittest.TestCase):
+    '''test generating blocks of combinations as columns'''
+
+    # @unittest.skip('why?')
+    def test_columns(self):
+        '''columns should hold the same combinations, marking the missing keys'''
+        for name, spec in sample_specs().items():
+            plan = ExpansionPlan(spec)
+            if plan.raw_results():
+                self.assertRaises(ValueError, next, ExpandCombinations(plan).batches(5))
+                continue
+            expected = list(plan)
+            for layered in (False, True):
+                with self.subTest(spec=name, layered=layered):
+                    rebuilt = []
+                    for batch in ExpandCombinations(plan, layered=layered).batches(5):
+                        self.assertEqual(list(plan.result_keys()), list(batch))
+                        rows = len(next(iter(batch.values())))
+                        self.assertLessEqual(rows, 5)
+                        rebuilt.extend({key: column[row_idx] for key, column in batch.items()
+                                        if column[row_idx] is not MISSING}
+                                       for row_idx in range(rows))
+                    self.assertEqual(expected, rebuilt)
+
+    # @unittest.skip('why?')
+    def test_missing(self):
+        '''keys not in a combination should be marked with the MISSING sentinel'''
+        batch = next(ExpandCombinations(sample_specs()['s3'], layered=True).batches(10))
+        self.assertEqual(['key1', 'key2', 'key3', 'key4'], list(batch))
+        self.assertEqual(['default value', 'default value', 'default value', 'override'],
+                         batch['key1'])
+        self.assertEqual(['option 1', MISSING, MISSING, 'keep key'], batch['key2'])
+        self.assertEqual([MISSING, 'option 2', 'option 3', MISSING], batch['key4'])
+        self.assertRaises(ValueError, next, ExpandCombinations({'k': [1]}).batches(0))
+        for spec in ({}, {'dummy': []}):  # the row count would be lost
+            self.assertRaises(ValueError, next, ExpandCombinations(spec).batches(10))
+
+    # @unittest.skip('why?')
+    def test_no_rows(self):
+        '''batches from an ordinary iterator should not build the row dictionaries'''
+        plan = ExpansionPlan(sample_specs()['sub2'])
+        walker = ExpandCombinations(plan, start=3, stop=40)
+        next(walker)
+        generated = []
+        original = ExpandCombinations.__next__
+
+        def spy(iterator):
+            generated.append(original(iterator))
+            return generated[-1]
+        with unittest.mock.patch.object(ExpandCombinations, '__next__', spy):
+            batches = walker.batches(10)
+            first = next(batches)
+        self.assertEqual(10, len(generated))
+        self.assertTrue(all(isinstance(cmb, LayeredCombination) for cmb in generated))
+        self.assertEqual(10, len(first['type']))
+        self.assertEqual(plan[4]['pinout'], first['pinout'][0])
+        self.assertEqual(plan[14], next(walker))  # moved past the block
+        self.assertEqual(25, sum(len(batch['type']) for batch in batches))
+        self.assertRaises(StopIteration, next, walker)
+        self.assertRaises(ValueError, next, ExpandCombinations(plan, unique=True).batches(5))
+
+    # @unittest.skip('why?')
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_arrays(self):
+        '''array batches should be masked where keys are missing'''
+        spec = sample_specs()['s3']
+        batch = next(ExpandCombinations(spec, layered=True).batches(10, arrays=True))
+        self.assertEqual(('key1', 'key2', 'key3', 'key4', ), batch.dtype.names)
+        self.assertEqual([False, True, True, False], list(batch.mask['key2']))
+        self.assertEqual('keep key', batch['key2'][3])
+        tuples = next(ExpandCombinations({'pair': [(1, 2), (3, 4)]}).batches(2, arrays=True))
+        self.assertEqual((3, 4), tuples['pair'][1])  # sequence values are kept whole
+
+
+class TestProductPath(unittest.TestCase):
+    '''test the direct cartesian product for dictionaries of simple lists'''
+
+    # @unittest.skip('why?')
+    def test_same_order(self):
+        '''product combinations should match the general (layer by layer) engine'''
+        specs = sample_specs()
+        specs['flat_empty'] = odict([('a', [1, 2]), ('skip', []), ('fixed', 'x'), ('b', [3, 4])])
+        specs['subtree'] = {'top': ['x', {'k1': [1, 2], 'k2': [3, 4]}], 'more': [5, 6]}
+        for name, spec in specs.items():
+            with self.subTest(spec=name):
+                # layered views always use the general engine
+                general = list(ExpandCombinations(spec, layered=True))
+                self.assertEqual(general, list(ExpandCombinations(spec)))
+                self.assertEqual(general[1:], list(ExpandCombinations(spec, start=1)))
+                self.assertEqual([list(cmb) for cmb in general if isinstance(cmb, Mapping)],
+                                 [list(cmb) for cmb in ExpandCombinations(spec)
+                                  if isinstance(cmb, dict)])
+
+    # @unittest.skip('why?')
+    def test_next_and_reset(self):
+        '''next and for loops should share the position, and reset should restart'''
+        spec = sample_specs()['meals']
+        expected = list(ExpandCombinations(spec, layered=True))
+        product = ExpandCombinations(spec)
+        self.assertEqual(expected[:2], [next(product), next(product)])
+        self.assertEqual(expected[2:], list(product))
+        self.assertRaises(StopIteration, next, product)
+        product.reset()
+        self.assertEqual(expected, list(product))
+
+
+class TestCheckpoint(unittest.TestCase):
+    '''test saving the iterator position, and resuming from it later'''
+
+    # @unittest.skip('why?')
+    def test_resume(self):
+        '''a resumed iterator should continue with the next combination'''
+        for name, spec in sample_specs().items():
+            expected = list(ExpandCombinations(spec))
+            for done in sorted({0, min(1, len(expected)), len(expected) // 2, len(expected)}):
+                with self.subTest(spec=name, done=done):
+                    walker = ExpandCombinations(spec)
+                    for dummy_idx in range(done):
+                        next(walker)
+                    token = json.loads(json.dumps(walker.checkpoint()))
+                    self.assertEqual(done, token['index'])
+                    self.assertEqual(expected[done:],
+                                     list(ExpandCombinations(spec, resume=token)))
+                    looped = ExpandCombinations(spec)
+                    for dummy_cmb in itertools.islice(looped, done):
+                        pass
+                    self.assertEqual(expected[done:],
+                                     list(ExpandCombinations(spec, resume=looped.checkpoint())))
+
+    # @unittest.skip('why?')
+    def test_resume_shard(self):
+        '''a checkpoint in a shard should only resume the rest of the shard'''
+        plan = ExpansionPlan(sample_specs()['sub2'])
+        shard = ExpandCombinations(plan, shard=(1, 3))
+        expected = list(shard)
+        shard.reset()
+        first = [next(shard) for dummy_idx in range(5)]
+        rest = list(ExpandCombinations(plan, resume=shard.checkpoint()))
+        self.assertEqual(expected, first + rest)
+
+    # @unittest.skip('why?')
+    def test_invalid(self):
+        '''checkpoints should only be used for the same expansion'''
+        spec = sample_specs()['meals']
+        token = ExpandCombinations(spec).checkpoint()
+        self.assertRaises(ValueError, ExpandCombinations, sample_specs()['s2'], resume=token)
+        self.assertRaises(ValueError, ExpandCombinations, spec, resume=token, start=3)
+        self.assertRaises(ValueError, ExpandCombinations(spec, unique=True).checkpoint)
+
+
+class TestConstraints(unittest.TestCase):
+    '''test skipping combinations that break rules, while they are being built'''
+
+    # @unittest.skip('why?')
+    def test_rules(self):
+        '''constrained expansions should match filtering the full expansion'''
+        cases = [
+            ('meals', [exclude({'appetizer': 'escargot', 'wine': 'white'})]),
+            ('meals', [include({'desert': ['pie', 'tiramisu']}, when={'entrée': 'steak'}),
+                       Constraint(lambda cmb: cmb['appetizer'] != 'calamari', ['appetizer'])]),
+            ('sub2', [include({'label': 'pin'}, when={'package': 'TO92'}),
+                      exclude({'type': 'PNP', 'pinout': ['BCE', 'BEC']})]),
+            ('s3', [exclude({'key1': 'override'})]),
+            ('pizza', [exclude({'first': 'bacon'}), lambda cmb: len(cmb) < 3]),
+        ]
+        for name, rules in cases:
+            full = list(ExpandCombinations(sample_specs()[name]))
+            expected = [cmb for cmb in full if all(Constraint(rule)(cmb) for rule in rules)]
+            self.assertLess(len(expected), len(full))
+            for layered in (False, True):
+                with self.subTest(spec=name, layered=layered):
+                    self.assertEqual(expected, list(ExpandCombinations(
+                        sample_specs()[name], constraints=rules, layered=layered)))
+
+    # @unittest.skip('why?')
+    def test_early_cutoff(self):
+        '''a rule should be checked once per partial combination, not per result'''
+        checked = []
+
+        def no_escargot(combination):
+            checked.append(combination['appetizer'])
+            return combination['appetizer'] != 'escargot'
+        walker = ExpandCombinations(sample_specs()['meals'],
+                                    constraints=[Constraint(no_escargot, ['appetizer'])])
+        self.assertEqual(48, len(list(walker)))
+        self.assertEqual(['calamari', 'potatoe skins', 'cheesy nachos', 'escargot'], checked)
+
+    # @unittest.skip('why?')
+    def test_counting(self):
+        '''count, sampling and lookup should only see the allowed combinations'''
+        rules = [exclude({'appetizer': 'escargot'}), exclude({'desert': 'pie'})]
+        walker = ExpandCombinations(sample_specs()['meals'], constraints=rules)
+        expected = list(walker)
+        self.assertEqual(36, walker.count())
+        picked = walker.sample(10, seed=3)
+        self.assertEqual(10, len(picked))
+        for cmb in picked + list(itertools.islice(walker.random_stream(seed=3), 20)):
+            self.assertIn(cmb, expected)
+            self.assertIn(cmb, walker)
+        self.assertNotIn(ExpandCombinations(sample_specs()['meals'])[0], walker)
+        self.assertRaises(ValueError, walker.__getitem__, 0)
+        self.assertRaises(ValueError, walker.index_of, expected[0])
+        self.assertRaises(ValueError, walker.checkpoint)
+        self.assertRaises(ValueError, ExpandCombinations, sample_specs()['meals'],
+                          constraints=rules, shard=(0, 2))
+        self.assertRaises(ValueError, ExpandCombinations, sample_specs()['l2'],
+                          constraints=rules)
+
+    # @unittest.skip('why?')
+    def test_calculated_count(self):
+        '''counts should match the generated combinations, calculated where possible'''
+        cases = [
+            ('meals', [exclude({'appetizer': 'escargot'}), exclude({'desert': 'pie'})], True),
+            ('meals', [exclude({'wine': 'red'})], True),
+            ('meals', [exclude({'appetizer': 'escargot', 'wine': 'white'})], False),
+            ('sub2', [exclude({'mounting': 'SMD'}), exclude({'type': 'PNP'})], True),
+            ('sub2', [exclude({'mounting': 'THT'}), exclude({'footprint': ''})], True),
+            ('sub2', [include({'label': 'pin'}, when={'package': 'TO92'})], False),
+            ('sub3', [exclude({'footprint': ['SIL', '']})], True),
+            ('meals', [lambda cmb: cmb['appetizer'] != 'escargot'], False),
+            ('pizza', [exclude({'first': 'bacon'}), exclude({'second': 'goat'})], True),
+            ('s2', [exclude({'key1': 'constant value'})], True),
+        ]
+        generated = []
+        original = ExpandCombinations._constrained
+
+        def spy(iterator):
+            generated.append(1)
+            return original(iterator)
+        for name, rules, calculated in cases:
+            with self.subTest(spec=name, rules=rules):
+                walker = ExpandCombinations(sample_specs()[name], constraints=rules)
+                expected = list(ExpandCombinations(sample_specs()[name], constraints=rules))
+                generated.clear()
+                with unittest.mock.patch.object(ExpandCombinations, '_constrained', spy):
+                    self.assertEqual(len(expected), walker.count())
+                self.assertEqual([] if calculated else [1], generated)
+                picked = walker.sample(min(5, len(expected)), seed=1)
+                self.assertEqual(picked, walker.sample(min(5, len(expected)), seed=1))
+                for cmb in picked:
+                    self.assertIn(cmb, expected)
+                self.assertEqual(len(picked), len(set(map(hashable_form, picked))))
+        walker = ExpandCombinations(sample_specs()['meals'],
+                                    constraints=[lambda cmb: cmb['desert'] != 'pie'])
+        generated.clear()
+        with unittest.mock.patch.object(ExpandCombinations, '_constrained', spy):
+            self.assertEqual(5, len(walker.sample(5, seed=2)))
+            self.assertEqual(48, walker.count())
+        self.assertEqual([1], generated)  # sampled and counted in a single pass
+        self.assertRaises(ValueError, walker.sample, 49)
+
+
+class TestPlanCache(unittest.TestCase):
+    '''test sharing the analysis (and small expansions) of repeated nested elements'''
+
+    # @unittest.skip('why?')
+    def test_shared_plans(self):
+        '''the same nested object should only be analysed once'''
+        plan = ExpansionPlan(sample_specs()['pizza'])
+        slot_plans = {id(child_plan) for dummy_idx, entry_plan in plan.nested()
+                      for dummy_key, child_plan in entry_plan.nested()}
+        self.assertEqual(1, len(slot_plans))
+        stats = plan.cache().stats()
+        self.assertEqual(8, stats['misses'])
+        self.assertEqual(5, stats['hits'])
+        self.assertEqual(0, stats['evictions'])
+
+    # @unittest.skip('why?')
+    def test_materialised(self):
+        '''saved small expansions should give the same (independent) combinations'''
+        for name, spec in sample_specs().items():
+            with self.subTest(spec=name):
+                expected = list(ExpansionPlan(spec, cache=PlanCache(materialise=0)))
+                self.assertEqual(expected, list(ExpansionPlan(spec)))
+                self.assertEqual(expected, list(ExpandCombinations(ExpansionPlan(spec),
+                                                                   layered=True)))
+        plan = ExpansionPlan({'fixed': 'x', 'more': [{'a': [1, 2]}, {'b': 3}]})
+        first = list(plan)
+        first[0]['a'] = 'changed'
+        self.assertEqual([{'fixed': 'x', 'a': 1}, {'fixed': 'x', 'a': 2},
+                          {'fixed': 'x', 'b': 3}], list(plan))
+
+    # @unittest.skip('why?')
+    def test_eviction(self):
+        '''the least recently used plans should be dropped when the cache is full'''
+        cache = PlanCache(maxsize=2)
+        sources = [[1, 2], [3, 4], [5, 6]]
+        plans = [cache.plan(source) for source in sources]
+        self.assertIs(plans[2], cache.plan(sources[2]))
+        self.assertIsNot(plans[0], cache.plan(sources[0]))
+        self.assertEqual({'hits': 1, 'misses': 4, 'evictions': 2, 'size': 2, 'maxsize': 2},
+                         cache.stats())
+
+
+class TestStats(unittest.TestCase):
+    '''test counting the work done while generating combinations'''
+
+    # @unittest.skip('why?')
+    def test_same_combinations(self):
+        '''counting should not change the generated combinations'''
+        for name, spec in sample_specs().items():
+            with self.subTest(spec=name):
+                expected = list(ExpandCombinations(spec))
+                self.assertEqual(expected, list(ExpandCombinations(spec, stats=True)))
+                self.assertEqual(expected, list(ExpandCombinations(spec, stats=True,
+                                                                   layered=True)))
+        self.assertIsNone(ExpandCombinations(sample_specs()['s1']).stats())
+        for off in (False, 0, None):
+            with self.subTest(stats=off):
+                walker = ExpandCombinations(sample_specs()['s2'], stats=off)
+                self.assertIsNone(walker.stats())
+                self.assertEqual(list(ExpandCombinations(sample_specs()['s2'])), list(walker))
+
+    # @unittest.skip('why?')
+    def test_counts(self):
+        '''the counts should match the work done for each layer'''
+        walker = ExpandCombinations(sample_specs()['s2'], stats=True)
+        self.assertEqual(4, len(list(walker)))
+        # each exhausted layer is restarted, including when the whole expansion is done
+        self.assertEqual({'value': 6, 'copy': 6, 'set': 6, 'restart': 3, 'result': 4},
+                         walker.stats().totals())
+        layers = walker.stats().layers()
+        self.assertEqual({('key2', ), ('key3', ), ()}, set(layers))
+        self.assertEqual(2, layers[('key2', )]['value'])
+        self.assertEqual(4, layers[('key3', )]['value'])
+        self.assertEqual(2, layers[('key3', )]['restart'])
+        self.assertGreater(layers[('key2', )]['seconds'], 0)
+        walker = ExpandCombinations(ExpansionPlan(sample_specs()['s3'],
+                                                  cache=PlanCache(materialise=0)), stats=True)
+        list(walker)
+        self.assertEqual({'update': 3, 'set': 3}, {
+            event: count for event, count in walker.stats().totals().items()
+            if event in ('update', 'set')})
+        self.assertIn(('key2', 1, 'key4'), walker.stats().layers())
+
+    # @unittest.skip('why?')
+    def test_callback(self):
+        '''the callback should see every event, and a shared stats instance add up'''
+        events = []
+        stats = ExpansionStats(lambda event, layer, seconds: events.append((event, layer)))
+        list(ExpandCombinations(sample_specs()['s1'], stats=stats))
+        self.assertEqual([('value', ('key2', )), ('copy', ('key2', )), ('set', ('key2', )),
+                          ('result', ())] * 2 + [('restart', ('key2', ))], events)
+        list(ExpandCombinations(sample_specs()['s1'], stats=stats, layered=True))
+        self.assertEqual(4, stats.totals()['result'])
+        self.assertEqual(2, stats.totals()['copy'])
+        stats.clear()
+        self.assertEqual({}, stats.totals())
+
+
+class TestCompactNodes(unittest.TestCase):
+    '''test the (slotted) state kept for each nested node'''
+
+    # @unittest.skip('why?')
+    def test_no_instance_dict(self):
+        '''iterator and plan nodes should not carry a per instance dictionary'''
+        walker = ExpandCombinations(sample_specs()['sub2'])
+        for node in (walker, walker.plan(), ExpandCombinations(sample_specs()['s1'],
+                                                                 stats=True)):
+            with self.subTest(node=type(node).__name__):
+                self.assertFalse(hasattr(node, '__dict__'))
+                with self.assertRaises(AttributeError):
+                    node.extra = 'not allowed'
+
+    # @unittest.skip('why?')
+    def test_keys_on_demand(self):
+        '''the key analysis should give the same result whenever it is first asked for'''
+        for name, spec in sample_specs().items():
+            with self.subTest(spec=name):
+                plan = ExpansionPlan(spec)
+                list(plan)
+                child_first = ExpansionPlan(spec)
+                for dummy_pos, child_plan in child_first.nested():
+                    child_plan.layer_keys()
+                self.assertEqual(plan.written_keys(), child_first.written_keys())
+                self.assertEqual(plan.layer_keys(), child_first.layer_keys())
+                self.assertEqual(plan.result_keys(), child_first.result_keys())
+
+
+class TestAsync(unittest.TestCase):
+    '''test asynchronous iteration, sharing the event loop'''
+
+    @staticmethod
+    def collect(source: object) -> list:
+        '''returns everything generated by async for over source'''
+        async def gather():
+            return [cmb async for cmb in source]
+        return asyncio.run(gather())
+
+    # @unittest.skip('why?')
+    def test_same_combinations(self):
+        '''async for should generate the same combinations as a for loop'''
+        for name, spec in sample_specs().items():
+            with self.subTest(spec=name):
+                expected = list(ExpandCombinations(spec))
+                self.assertEqual(expected, self.collect(ExpandCombinations(spec)))
+                self.assertEqual(expected, self.collect(AsyncCombinations(spec, every=3)))
+        self.assertEqual(list(ExpandCombinations(sample_specs()['sub2'], start=5, stop=50)),
+                         self.collect(AsyncCombinations(sample_specs()['sub2'], start=5,
+                                                        stop=50)))
+        with self.assertRaises(ValueError):
+            AsyncCombinations(sample_specs()['s1'], every=0)
+        with self.assertRaises(ValueError):
+            AsyncCombinations(ExpandCombinations(sample_specs()['s1']), stop=1)
+
+    # @unittest.skip('why?')
+    def test_shares_loop(self):
+        '''other tasks should get turns while the combinations are generated'''
+        async def run():
+            ticks = []
+            walker = AsyncCombinations(sample_specs()['sub2'], every=10)
+
+            async def ticker():
+                while True:
+                    ticks.append(len(generated))
+                    await asyncio.sleep(0)
+            generated = []
+            task = asyncio.ensure_future(ticker())
+            async for cmb in walker:
+                generated.append(cmb)
+            task.cancel()
+            return ticks
+        ticks = asyncio.run(run())
+        self.assertGreaterEqual(len(set(ticks)), 96 // 10)
+        self.assertEqual(0, ticks[0])
+
+    # @unittest.skip('why?')
+    def test_checkpoint(self):
+        '''resuming from an async checkpoint should not skip the prefetched block'''
+        for name in ('sub2', 'meals', 'list1', 'l2'):
+            with self.subTest(spec=name):
+                spec = sample_specs()[name]
+                expected = list(ExpandCombinations(spec))
+
+                async def run():
+                    walker = AsyncCombinations(spec, every=50)
+                    used = []
+                    async for cmb in walker:
+                        used.append(cmb)
+                        if len(used) == 2:
+                            break
+                    return used, walker.checkpoint()
+                used, token = asyncio.run(run())
+                self.assertEqual(2, token['index'])
+                self.assertEqual(expected, used + list(ExpandCombinations(spec,
+                                                                          resume=token)))
+
+    # @unittest.skip('why?')
+    def test_batches(self):
+        '''async batches should split the combinations into lists of the requested size'''
+        async def run(size):
+            return [rows async for rows in AsyncCombinations(
+                sample_specs()['sub2'], every=7).batches(size)]
+        expected = list(ExpandCombinations(sample_specs()['sub2']))
+        for size in (1, 10, 96, 200):
+            with self.subTest(size=size):
+                rows = asyncio.run(run(size))
+                self.assertEqual(expected, [cmb for block in rows for cmb in block])
+                self.assertEqual([size] * (len(rows) - 1),
+                                 [len(block) for block in rows[:-1]])
+
+
+class TestCommandLine(unittest.TestCase):
+    '''test the python -m expand_combinations streaming tool'''
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def _spec_file(self, name: str) -> str:
+        '''write a sample specification to a JSON file'''
+        path = os.path.join(self.folder.name, name + '.json')
+        with open(path, 'w', encoding='utf-8') as spec_file:
+            json.dump(sample_specs()[name], spec_file)
+        return path
+
+    def _run(self, *args) -> str:
+        '''run the tool, returning anything it printed'''
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as printed:
+            self.assertEqual(0, main(list(args)))
+        return printed.getvalue()
+
+    # @unittest.skip('why?')
+    def test_jsonl(self):
+        '''JSON lines output (plain and compressed) should hold every combination'''
+        for name in ('s2', 's3', 'meals', 'pizza'):
+            with self.subTest(spec=name):
+                expected = json.loads(json.dumps(list(ExpandCombinations(sample_specs()[name]))))
+                output = os.path.join(self.folder.name, 'out.jsonl')
+                self._run(self._spec_file(name), '-o', output)
+                with open(output, encoding='utf-8') as lines:
+                    self.assertEqual(expected, [json.loads(line) for line in lines])
+                self._run(self._spec_file(name), '-o', output + '.gz')
+                with gzip.open(output + '.gz', 'rt', encoding='utf-8') as lines:
+                    self.assertEqual(expected, [json.loads(line) for line in lines])
+
+    # @unittest.skip('why?')
+    def test_csv(self):
+        '''CSV output should have a column for every key, empty where missing'''
+        for name in ('s2', 's3', 'meals'):
+            with self.subTest(spec=name):
+                expected = list(ExpandCombinations(sample_specs()[name]))
+                output = os.path.join(self.folder.name, 'out.csv')
+                self._run(self._spec_file(name), '-o', output)
+                with open(output, encoding='utf-8', newline='') as rows:
+                    rebuilt = [{key: value for key, value in row.items() if value}
+                               for row in csv.DictReader(rows)]
+                self.assertEqual(expected, rebuilt)
+
+    # @unittest.skip('why?')
+    def test_selection(self):
+        '''offset, limit and shard should select the same combinations as slicing'''
+        for name in ('s2', 'sub2'):
+            expected = json.loads(json.dumps(list(ExpandCombinations(sample_specs()[name]))))
+            spec_path = self._spec_file(name)
+            output = os.path.join(self.folder.name, 'out.jsonl')
+            for args, selected in ((['--offset', '3', '--limit', '5'], expected[3:8]),
+                                   (['--shard', '1/3'], expected[len(expected) // 3:
+                                                                 2 * len(expected) // 3]),
+                                   (['--shard', '2/3', '--offset', '1', '--limit', '2'],
+                                    expected[2 * len(expected) // 3 + 1:
+                                             2 * len(expected) // 3 + 3])):
+                with self.subTest(spec=name, args=args):
+                    self._run(spec_path, '-o', output, *args)
+                    with open(output, encoding='utf-8') as lines:
+                        self.assertEqual(selected, [json.loads(line) for line in lines])
+                    self.assertEqual(str(len(selected)),
+                                     self._run(spec_path, '--count', *args).strip())
+
+    # @unittest.skip('why?')
+    @unittest.skipIf(yaml is None, 'PyYAML is not installed')
+    def test_yaml(self):
+        '''YAML specifications should expand the same as JSON'''
+        path = os.path.join(self.folder.name, 'meals.yaml')
+        with open(path, 'w', encoding='utf-8') as spec_file:
+            yaml.safe_dump(sample_specs()['meals'], spec_file, allow_unicode=True)
+        self.assertEqual('64', self._run(path, '--count').strip())
+        path = os.path.join(self.folder.name, 'slots.yaml')
+        with open(path, 'w', encoding='utf-8') as spec_file:
+            spec_file.write('first: [a, b, c]\nsecond: [a, b, c]\n')
+        self.assertEqual('9', self._run(path, '--count').strip())
+        self.assertEqual('6', self._run(path, '--count', '--interchangeable',
+                                        'first,second').strip())
+
+    # @unittest.skip('why?')
+    def test_invalid(self):
+        '''bad arguments should be reported, not raise exceptions'''
+        spec_path = self._spec_file('s3')
+        with unittest.mock.patch('sys.stderr', new_callable=io.StringIO):
+            for args in (['--shard', 'x'], ['--shard', '3/2'], ['--offset', '-1'],
+                         ['-f', 'xml'], [os.path.join(self.folder.name, 'missing.json')]):
+                with self.subTest(args=args):
+                    with self.assertRaises(SystemExit):
+                        main([spec_path] + args if args[0].startswith('-') else args)
+            output = os.path.join(self.folder.name, 'out.csv')
+            for name in ('list1', 'l2'):  # some combinations are not dictionaries
+                with self.subTest(spec=name):
+                    with self.assertRaises(SystemExit):
+                        main([self._spec_file(name), '-o', output])
+                    with open(output, encoding='utf-8') as partial:
+                        self.assertEqual('', partial.read())
+
+
+class TestBenchmarks(unittest.TestCase):
+    '''test the benchmark specification generator and result comparison'''
+
+    # @unittest.skip('why?')
+    def test_synthetic_spec(self):
+        '''generated specifications should have the requested shape, repeatably'''
+        flat = synthetic_spec(depth=1, width=3, list_length=4, static=2)
+        self.assertEqual(64, ExpansionPlan(flat).count())
+        self.assertEqual(5, len(flat))
+        nested = synthetic_spec(depth=3, nested_ratio=0.5, shared_ratio=0.5, seed=7)
+        self.assertEqual(nested, synthetic_spec(depth=3, nested_ratio=0.5, shared_ratio=0.5,
+                                                seed=7))
+        plan = ExpansionPlan(nested)
+        self.assertGreater(plan.cache().stats()['hits'], 0)
+        results = measure(flat, limit=10, repeat=1)
+        self.assertEqual(64, results['count'])
+        self.assertEqual(10, results['generated'])
+        self.assertGreater(results['plan_kib'], 0)
+        self.assertGreater(results['iterator_kib'], 0)
+
+    # @unittest.skip('why?')
+    def test_compare(self):
+        '''slower times and fewer combinations per second should be regressions'''
+        before = {'results': {'case': {'iterate_s': 1.0, 'per_second': 100.0},
+                              'dropped': {'iterate_s': 1.0}}}
+        after = {'results': {'case': {'iterate_s': 1.3, 'per_second': 95.0}}}
+        changes = compare_results(before, after, threshold=0.1)
+        self.assertEqual([('case', 'iterate_s', True), ('case', 'per_second', False)],
+                         [(name, key, regressed) for name, key, dummy_old, dummy_new,
+                          dummy_change, regressed in changes])
+        self.assertAlmostEqual(0.3, changes[0][4])
+        self.assertTrue(compare_results(before, after, threshold=0.01)[1][5])
+
+
 # py lint: disable=«warnings about accessing private members»
 # class TestInternals(unittest.TestCase):
 # instance.simple_list